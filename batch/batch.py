@@ -0,0 +1,203 @@
+# runs the functions for many Pipedrive connections at once; each function
+# is run for each connection on a worker pool with a cap on the number of
+# calls running at once overall and for each connection, and the output of
+# each call is written to its own file
+#
+# the jobs are given as a json file:
+#
+#   {
+#     "connections": [
+#       {"name": "acme", "access_token": "...", "api_base_uri": "https://acme.pipedrive.com"}
+#     ],
+#     "functions": ["deals", "people"],
+#     "params": {"format": "csv"}
+#   }
+#
+# and the output for each is written to <output-dir>/<connection>/<function>.<format>
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import importlib.util
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FUNCTIONS = ['deals', 'people', 'organizations', 'activity', 'products']
+
+class FlexOutput:
+
+    def __init__(self, file):
+        self.content_type = None
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data)
+
+class Flex:
+
+    def __init__(self, params, file):
+        self.vars = params
+        self.output = FlexOutput(file)
+
+def load_functions(names):
+
+    # the rate limit applies per access token across all of the endpoints,
+    # so the functions share their rate limiters; calls for one connection
+    # then pace each other while calls for other connections aren't affected
+    rate_limiters = {}
+    rate_limiters_lock = threading.Lock()
+
+    modules = OrderedDict()
+    for name in names:
+        path = os.path.join(ROOT_DIR, 'pipedrive-' + name + '.py')
+        if not os.path.exists(path):
+            raise ValueError("Invalid function: '" + name + "'")
+        spec = importlib.util.spec_from_file_location('pipedrive_' + name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.rate_limiters = rate_limiters
+        module.rate_limiters_lock = rate_limiters_lock
+        modules[name] = module
+    return modules
+
+def get_jobs(connections, names):
+
+    # interleave the jobs of the connections so that each connection makes
+    # progress rather than one connection's jobs running ahead of the rest
+    jobs = deque()
+    for name in names:
+        for connection in connections:
+            jobs.append((connection, name))
+    return jobs
+
+def get_output_path(output_dir, connection, name, module, params):
+    output_format = module.get_output_format(params)
+    extension = '.' + output_format
+    if module.get_output_compression(params) == 'gzip':
+        extension = extension + '.gz'
+    return os.path.join(output_dir, connection['name'], name + extension)
+
+def run_job(name, module, connection, params, output_dir):
+
+    connection_params = dict((k, v) for k, v in connection.items() if k != 'name')
+    params = dict(params, pipedrive_connection=connection_params)
+    path = get_output_path(output_dir, connection, name, module, params)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # the output is written to a temporary file that replaces the output
+    # file once the call succeeds, so a failed call leaves the previous
+    # output in place
+    metrics = module.Metrics()
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), prefix='.', delete=False) as f:
+        try:
+            module.flexio_handler(Flex(params, f), metrics)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+    elapsed = time.perf_counter() - start
+    metrics = metrics.get_summary()
+
+    return {
+        'path': path,
+        'seconds': elapsed,
+        'rows': metrics['rows'],
+        'requests': metrics['requests'],
+        'rate_limited': metrics['rate_limited'],
+        'bytes_out': metrics['bytes_out']
+    }
+
+def run_batch(connections, names, params, output_dir, concurrency=8, connection_concurrency=2):
+
+    # jobs are only started when there's a free worker and the connection
+    # is below its cap, so a busy connection doesn't hold up workers that
+    # could run the jobs of other connections
+    for connection in connections:
+        if not connection.get('name') or not connection.get('access_token') or not connection.get('api_base_uri'):
+            raise ValueError("Each connection requires a 'name', 'access_token' and 'api_base_uri'")
+    if len(set(c['name'] for c in connections)) != len(connections):
+        raise ValueError("Connection names must be unique")
+
+    modules = load_functions(names)
+    pending = get_jobs(connections, names)
+    running = {}
+    running_counts = {}
+    results = []
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        while len(pending) > 0 or len(running) > 0:
+
+            waiting = deque()
+            while len(pending) > 0 and len(running) < concurrency:
+                connection, name = pending.popleft()
+                if running_counts.get(connection['name'], 0) >= connection_concurrency:
+                    waiting.append((connection, name))
+                    continue
+                future = executor.submit(run_job, name, modules[name], connection, params, output_dir)
+                running[future] = (connection, name)
+                running_counts[connection['name']] = running_counts.get(connection['name'], 0) + 1
+            pending.extendleft(reversed(waiting))
+
+            done, not_done = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                connection, name = running.pop(future)
+                running_counts[connection['name']] = running_counts[connection['name']] - 1
+
+                result = OrderedDict([('connection', connection['name']), ('function', name)])
+                try:
+                    result.update(future.result())
+                    result['error'] = None
+                except Exception as e:
+                    result['error'] = str(e)
+                results.append(result)
+    finally:
+        executor.shutdown(wait=True)
+
+    return results
+
+def print_results(results):
+    columns = ['connection', 'function', 'rows', 'requests', 'rate_limited', 'seconds', 'status']
+    print(('%-24s' + '%-16s' + '%14s' * (len(columns) - 2)) % tuple(columns))
+    for r in results:
+        if r['error'] is not None:
+            print(('%-24s' + '%-16s' + '%14s' * 4 + '  %s') % (r['connection'], r['function'], '', '', '', '', 'error: ' + r['error']))
+            continue
+        print(('%-24s' + '%-16s' + '%14d' * 3 + '%14.3f' + '%14s') % (
+            r['connection'], r['function'], r['rows'], r['requests'], r['rate_limited'], r['seconds'], 'ok'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Pipedrive functions for many connections')
+    parser.add_argument('jobs', help='json file with the connections, functions and params to run')
+    parser.add_argument('--output-dir', default='.', help='directory to write the output of each call to')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of calls to run at once')
+    parser.add_argument('--connection-concurrency', type=int, default=2, help='number of calls to run at once for each connection')
+    parser.add_argument('--results', help='file to write the results to as json')
+    args = parser.parse_args()
+
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+
+    names = jobs.get('functions') or FUNCTIONS
+    results = run_batch(jobs.get('connections') or [], names, jobs.get('params') or {}, args.output_dir,
+        concurrency=args.concurrency, connection_concurrency=args.connection_concurrency)
+
+    print_results(results)
+
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+
+    if any(r['error'] is not None for r in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
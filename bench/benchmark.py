@@ -0,0 +1,134 @@
+# end-to-end benchmark of the functions against the local mock server; each
+# function is run in its own process with a fake flex object and the rows,
+# pages, peak memory and time spent in each stage are reported; when a
+# minimum throughput is given, the benchmark fails for functions below it
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+import importlib.util
+
+from mock_server import start_server
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FUNCTIONS = ['deals', 'people', 'organizations', 'activity', 'products']
+
+class FlexOutput:
+
+    def __init__(self):
+        self.content_type = None
+        self.bytes = 0
+        self.write_time = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.bytes = self.bytes + len(data)
+        self.write_time = self.write_time + time.perf_counter() - start
+
+class Flex:
+
+    def __init__(self, params):
+        self.vars = params
+        self.output = FlexOutput()
+
+def load_function(name):
+    path = os.path.join(ROOT_DIR, 'pipedrive-' + name + '.py')
+    spec = importlib.util.spec_from_file_location('pipedrive_' + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_function(name, server_url, params):
+
+    module = load_function(name)
+
+    # always measure requests against the server rather than local caches
+    module.CACHE_TTL = 0
+    module.MIRROR_DIR = tempfile.mkdtemp()
+
+    # the stage timings and counts are taken from the metrics the function
+    # records for the call
+    module.METRICS_LOG = False
+
+    flex = Flex(dict(params, pipedrive_connection={'access_token': 'benchmark', 'api_base_uri': server_url}))
+    metrics = module.Metrics()
+    start = time.perf_counter()
+    module.flexio_handler(flex, metrics)
+    elapsed = time.perf_counter() - start
+    metrics = metrics.get_summary()
+
+    return {
+        'function': name,
+        'seconds': elapsed,
+        'rows': metrics['rows'],
+        'pages': metrics['pages'],
+        'bytes_out': flex.output.bytes,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'fetch_seconds': metrics['request_seconds'],
+        'wait_seconds': metrics['wait_seconds'],
+        'map_seconds': metrics['map_seconds'],
+        'encode_seconds': metrics['encode_seconds'],
+        'write_seconds': flex.output.write_time
+    }
+
+def run_function_process(name, server_url, params):
+
+    # run in a separate process so peak memory is measured per function
+    args = [sys.executable, os.path.abspath(__file__), '--run', name, '--server', server_url, '--params', json.dumps(params)]
+    output = subprocess.check_output(args, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def print_results(results):
+    columns = ['function', 'rows', 'rows/s', 'pages', 'pages/s', 'bytes_out', 'seconds', 'peak_rss_mb', 'fetch', 'wait', 'map', 'encode', 'write']
+    print(('%-14s' + '%12s' * (len(columns) - 1)) % tuple(columns))
+    for r in results:
+        print(('%-14s' + '%12d' + '%12.0f' + '%12d' + '%12.1f' + '%12d' + '%12.3f' + '%12.1f' + '%12.3f' * 5) % (
+            r['function'], r['rows'], r['rows'] / r['seconds'], r['pages'], r['pages'] / r['seconds'], r['bytes_out'], r['seconds'],
+            r['peak_rss_mb'], r['fetch_seconds'], r['wait_seconds'], r['map_seconds'], r['encode_seconds'], r['write_seconds']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Pipedrive functions against a local mock server')
+    parser.add_argument('--functions', default=','.join(FUNCTIONS), help='comma-delimited list of functions to run')
+    parser.add_argument('--count', type=int, default=20000, help='number of items for each entity')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with a 503')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests allowed per two second window')
+    parser.add_argument('--params', default='{}', help='json object of function params, e.g. {"properties": "id,title"}')
+    parser.add_argument('--output', help='file to write the results to as json')
+    parser.add_argument('--min-rows-per-second', type=float, help='fail when a function returns fewer rows per second')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    params = json.loads(args.params)
+
+    if args.run is not None:
+        print(json.dumps(run_function(args.run, args.server, params)))
+        return
+
+    server = start_server(count=args.count, latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    results = [run_function_process(name.strip(), server.url, params) for name in args.functions.split(',')]
+    server.shutdown()
+
+    print_results(results)
+    print('server: %(requests)d requests, %(bytes)d bytes, %(errors)d errors, %(rate_limited)d rate limited' % server.stats)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'server': server.stats}, f, indent=2)
+
+    if args.min_rows_per_second is not None:
+        failed = [r for r in results if r['rows'] / r['seconds'] < args.min_rows_per_second]
+        for r in failed:
+            print('%s: %.0f rows/s is below the minimum of %.0f rows/s' % (r['function'], r['rows'] / r['seconds'], args.min_rows_per_second))
+        if len(failed) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,509 @@
+# local stand-in for the Pipedrive api used by the benchmarks and tests;
+# serves synthetic pages for the endpoints the functions use, with
+# pagination, rate limit headers, configurable latency and injected 429/5xx
+# errors; items can be changed and deleted to exercise incremental syncs
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+USER_COUNT = 20
+PIPELINE_COUNT = 3
+STAGES_PER_PIPELINE = 5
+CURRENCIES = ['USD', 'EUR', 'GBP', 'CAD', 'AUD']
+ACTIVITY_TYPES = ['call', 'meeting', 'task', 'deadline', 'email', 'lunch']
+
+def get_time(i, base_year=2020):
+    return '%04d-%02d-%02d %02d:%02d:%02d' % (base_year + i % 3, 1 + i % 12, 1 + i % 28, i % 24, i % 60, (i * 7) % 60)
+
+def get_user(i):
+    i = 1 + i % USER_COUNT
+    return {'id': i, 'name': 'User %d' % i, 'email': 'user%d@example.com' % i, 'has_pic': 0, 'pic_hash': None, 'active_flag': True, 'value': i}
+
+def get_person_ref(i):
+    return {
+        'active_flag': True,
+        'name': 'Person %d' % i,
+        'email': [{'label': 'work', 'value': 'person%d@example.com' % i, 'primary': True}],
+        'phone': [{'label': 'work', 'value': '+1 555 %07d' % i, 'primary': True}],
+        'value': i
+    }
+
+def get_org_ref(i, count):
+    return {'name': 'Organization %d' % i, 'people_count': 1 + count // 10, 'owner_id': 1 + i % USER_COUNT, 'address': '%d Main St, Springfield' % i, 'active_flag': True, 'cc_email': 'org%d@example.pipedrivemail.com' % i, 'value': i}
+
+def get_deal(i, count):
+    stage_id = 1 + i % (PIPELINE_COUNT * STAGES_PER_PIPELINE)
+    status = ['open', 'open', 'won', 'lost'][i % 4]
+    return {
+        'id': i,
+        'creator_user_id': get_user(i),
+        'user_id': get_user(i + 1),
+        'person_id': get_person_ref(1 + i % count),
+        'org_id': get_org_ref(1 + i % max(1, count // 10), count),
+        'stage_id': stage_id,
+        'title': 'Deal %d' % i,
+        'value': (i * 37) % 10000,
+        'currency': CURRENCIES[i % len(CURRENCIES)],
+        'add_time': get_time(i),
+        'update_time': get_time(i, 2021),
+        'stage_change_time': get_time(i + 1, 2021),
+        'active': status == 'open',
+        'deleted': False,
+        'status': status,
+        'probability': None,
+        'next_activity_date': get_time(i + 2, 2022)[:10],
+        'next_activity_time': None,
+        'next_activity_id': i * 2,
+        'last_activity_id': i * 2 - 1,
+        'last_activity_date': get_time(i + 3, 2021)[:10],
+        'lost_reason': 'Price' if status == 'lost' else None,
+        'visible_to': '3',
+        'close_time': get_time(i + 4, 2022) if status != 'open' else None,
+        'pipeline_id': 1 + (stage_id - 1) // STAGES_PER_PIPELINE,
+        'won_time': get_time(i + 4, 2022) if status == 'won' else None,
+        'first_won_time': None,
+        'lost_time': get_time(i + 4, 2022) if status == 'lost' else None,
+        'products_count': i % 4,
+        'files_count': i % 3,
+        'notes_count': i % 5,
+        'followers_count': 1,
+        'email_messages_count': i % 7,
+        'activities_count': i % 9,
+        'done_activities_count': i % 5,
+        'undone_activities_count': i % 4,
+        'reference_activities_count': 0,
+        'participants_count': 1,
+        'expected_close_date': get_time(i + 5, 2022)[:10],
+        'last_incoming_mail_time': None,
+        'last_outgoing_mail_time': None,
+        'label': None,
+        'stage_order_nr': 0,
+        'person_name': 'Person %d' % (1 + i % count),
+        'org_name': 'Organization %d' % (1 + i % max(1, count // 10)),
+        'next_activity_subject': 'Follow up %d' % i,
+        'next_activity_type': ACTIVITY_TYPES[i % len(ACTIVITY_TYPES)],
+        'next_activity_duration': '00:30:00',
+        'next_activity_note': 'Discuss the proposal for deal %d' % i,
+        'formatted_value': '$%d' % ((i * 37) % 10000),
+        'weighted_value': (i * 37) % 10000,
+        'owner_name': 'User %d' % (1 + (i + 1) % USER_COUNT),
+        'cc_email': 'deal%d@example.pipedrivemail.com' % i,
+        'org_hidden': False,
+        'person_hidden': False
+    }
+
+def get_person(i, count):
+    person = get_person_ref(i)
+    person.update({
+        'id': i,
+        'company_id': 1,
+        'owner_id': get_user(i),
+        'org_id': get_org_ref(1 + i % max(1, count // 10), count),
+        'first_name': 'Person',
+        'last_name': str(i),
+        'label': None,
+        'open_deals_count': i % 3,
+        'related_open_deals_count': 0,
+        'closed_deals_count': i % 2,
+        'related_closed_deals_count': 0,
+        'participant_open_deals_count': 0,
+        'participant_closed_deals_count': 0,
+        'email_messages_count': i % 11,
+        'activities_count': i % 9,
+        'done_activities_count': i % 5,
+        'undone_activities_count': i % 4,
+        'reference_activities_count': 0,
+        'files_count': 0,
+        'notes_count': i % 4,
+        'followers_count': 1,
+        'won_deals_count': i % 2,
+        'related_won_deals_count': 0,
+        'lost_deals_count': 0,
+        'related_lost_deals_count': 0,
+        'add_time': get_time(i),
+        'update_time': get_time(i, 2021),
+        'visible_to': '3',
+        'next_activity_date': None,
+        'next_activity_id': None,
+        'last_activity_id': i * 2 - 1,
+        'last_activity_date': get_time(i + 3, 2021)[:10],
+        'org_name': 'Organization %d' % (1 + i % max(1, count // 10)),
+        'owner_name': 'User %d' % (1 + i % USER_COUNT)
+    })
+    person['email'] = person['email'] + [{'label': 'home', 'value': 'home%d@example.net' % i, 'primary': False}]
+    return person
+
+def get_organization(i, count):
+    org = get_org_ref(i, count)
+    org.update({
+        'id': i,
+        'company_id': 1,
+        'owner_id': get_user(i),
+        'label': None,
+        'open_deals_count': i % 6,
+        'related_open_deals_count': 0,
+        'closed_deals_count': i % 4,
+        'related_closed_deals_count': 0,
+        'email_messages_count': i % 13,
+        'activities_count': i % 9,
+        'done_activities_count': i % 5,
+        'undone_activities_count': i % 4,
+        'reference_activities_count': 0,
+        'files_count': 0,
+        'notes_count': i % 4,
+        'followers_count': 1,
+        'won_deals_count': i % 3,
+        'related_won_deals_count': 0,
+        'lost_deals_count': i % 2,
+        'related_lost_deals_count': 0,
+        'add_time': get_time(i),
+        'update_time': get_time(i, 2021),
+        'visible_to': '3',
+        'last_activity_id': i * 2 - 1,
+        'last_activity_date': get_time(i + 3, 2021)[:10],
+        'next_activity_id': None,
+        'next_activity_date': None,
+        'address_subpremise': '',
+        'address_street_number': str(i),
+        'address_route': 'Main St',
+        'address_sublocality': '',
+        'address_locality': 'Springfield',
+        'address_admin_area_level_1': 'Illinois',
+        'address_admin_area_level_2': 'Sangamon County',
+        'address_country': 'United States',
+        'address_postal_code': '62701',
+        'address_formatted_address': '%d Main St, Springfield, IL 62701, USA' % i,
+        'owner_name': 'User %d' % (1 + i % USER_COUNT)
+    })
+    return org
+
+def get_activity(i, count):
+    return {
+        'id': i,
+        'company_id': 1,
+        'user_id': 1 + i % USER_COUNT,
+        'done': i % 3 == 0,
+        'type': ACTIVITY_TYPES[i % len(ACTIVITY_TYPES)],
+        'reference_type': None,
+        'reference_id': None,
+        'conference_meeting_client': None,
+        'conference_meeting_url': None,
+        'due_date': get_time(i, 2022)[:10],
+        'due_time': '%02d:00' % (i % 24),
+        'duration': '00:30',
+        'busy_flag': None,
+        'add_time': get_time(i),
+        'marked_as_done_time': get_time(i, 2022) if i % 3 == 0 else '',
+        'last_notification_time': None,
+        'last_notification_user_id': None,
+        'notification_language_id': None,
+        'subject': 'Activity %d' % i,
+        'public_description': None,
+        'calendar_sync_include_context': None,
+        'location': None,
+        'org_id': 1 + i % max(1, count // 10),
+        'person_id': 1 + i % count,
+        'deal_id': 1 + i % count,
+        'lead_id': None,
+        'active_flag': True,
+        'update_time': get_time(i, 2021),
+        'update_user_id': None,
+        'gcal_event_id': None,
+        'google_calendar_id': None,
+        'google_calendar_etag': None,
+        'source_timezone': None,
+        'rec_rule': None,
+        'rec_rule_extension': None,
+        'rec_master_activity_id': None,
+        'series': [],
+        'note': ('Notes for activity %d. ' % i) * (1 + i % 20),
+        'created_by_user_id': 1,
+        'location_subpremise': None,
+        'location_street_number': None,
+        'location_route': None,
+        'location_sublocality': None,
+        'location_locality': None,
+        'location_admin_area_level_1': None,
+        'location_admin_area_level_2': None,
+        'location_country': None,
+        'location_postal_code': None,
+        'location_formatted_address': None,
+        'attendees': None,
+        'participants': [{'person_id': 1 + i % count, 'primary_flag': True}],
+        'org_name': 'Organization %d' % (1 + i % max(1, count // 10)),
+        'person_name': 'Person %d' % (1 + i % count),
+        'deal_title': 'Deal %d' % (1 + i % count),
+        'lead_title': None,
+        'owner_name': 'User %d' % (1 + i % USER_COUNT),
+        'person_dropbox_bcc': None,
+        'deal_dropbox_bcc': None,
+        'assigned_to_user_id': 1 + i % USER_COUNT,
+        'file': None
+    }
+
+def get_product(i, count):
+    return {
+        'id': i,
+        'name': 'Product %d' % i,
+        'code': 'P-%05d' % i,
+        'description': 'Description of product %d' % i,
+        'unit': 'each',
+        'tax': 0,
+        'category': None,
+        'active_flag': True,
+        'selectable': True,
+        'first_char': 'p',
+        'visible_to': '3',
+        'owner_id': get_user(i),
+        'files_count': None,
+        'followers_count': 1,
+        'add_time': get_time(i),
+        'update_time': get_time(i, 2021),
+        'prices': [
+            {'id': i * 10 + n, 'product_id': i, 'price': 10 + i % 100 + n, 'currency': currency, 'cost': 5, 'overhead_cost': 1}
+            for n, currency in enumerate(CURRENCIES[:1 + i % len(CURRENCIES)])
+        ]
+    }
+
+ENTITIES = {
+    'deals': ('deal', get_deal),
+    'persons': ('person', get_person),
+    'organizations': ('organization', get_organization),
+    'activities': ('activity', get_activity),
+    'products': ('product', get_product)
+}
+
+def get_search_values(item, field):
+
+    # the values of an item that the search endpoints match against
+    value = item.get(field)
+    if isinstance(value, list):
+        return [v.get('value') for v in value]
+    return [value]
+
+def is_search_match(item, fields, term, exact_match):
+    term = term.lower()
+    for field in fields:
+        for value in get_search_values(item, field):
+            if value is None:
+                continue
+            value = str(value).lower()
+            if value == term or (exact_match == False and term in value):
+                return True
+    return False
+
+def is_deleted(entity, item):
+
+    # deleted deals are flagged as deleted and other deleted items are made
+    # inactive, except for products, which can also be made inactive while
+    # still being returned
+    if entity in ('deals', 'products'):
+        return item.get('deleted') == True
+    return item.get('active_flag') == False
+
+def get_reference_data(path):
+    if path == 'users':
+        return [get_user(i) for i in range(USER_COUNT)]
+    if path == 'pipelines':
+        return [{'id': i, 'name': 'Pipeline %d' % i, 'active': True} for i in range(1, PIPELINE_COUNT + 1)]
+    if path == 'stages':
+        return [{'id': i, 'name': 'Stage %d' % i, 'pipeline_id': 1 + (i - 1) // STAGES_PER_PIPELINE} for i in range(1, PIPELINE_COUNT * STAGES_PER_PIPELINE + 1)]
+    if path == 'activityTypes':
+        return [{'id': i + 1, 'name': t.title(), 'key_string': t, 'active_flag': True} for i, t in enumerate(ACTIVITY_TYPES)]
+    return None
+
+class MockServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, count=1000, latency=0, error_rate=0, rate_limit=0):
+        ThreadingHTTPServer.__init__(self, address, MockRequestHandler)
+        self.count = count
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'rate_limited': 0}
+        self.paths = []
+        self.changes = {}
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def handle_error(self, request, client_address):
+
+        # clients closing the connections they kept alive aren't errors
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def update_item(self, entity, item_id, **values):
+
+        # change the values of an item the way an edit in pipedrive would;
+        # changed items are returned by the recents endpoint and items that
+        # are marked as deleted are left out of the item list
+        with self.lock:
+            self.changes.setdefault((entity, item_id), {}).update(values)
+
+    def get_item(self, entity, item_id):
+        item = ENTITIES[entity][1](item_id, self.count)
+        with self.lock:
+            item.update(self.changes.get((entity, item_id), {}))
+        return item
+
+    def get_changed_ids(self, entity):
+        with self.lock:
+            return [i for e, i in self.changes.keys() if e == entity]
+
+    def check_rate_limit(self, path):
+
+        # rate limit over a fixed two second window like the pipedrive api;
+        # returns the remaining requests and the seconds until the reset
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 2:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count = self.window_count + 1
+            self.stats['requests'] = self.stats['requests'] + 1
+            self.paths.append(path)
+            return self.rate_limit - self.window_count, 2 - (now - self.window_start)
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.strip('/').split('/')
+
+        remaining, reset = server.check_rate_limit(self.path)
+        headers = {}
+        if server.rate_limit > 0:
+            headers['X-RateLimit-Limit'] = str(server.rate_limit)
+            headers['X-RateLimit-Remaining'] = str(max(0, remaining))
+            headers['X-RateLimit-Reset'] = str(max(1, int(reset + 0.5)))
+            if remaining < 0:
+                with server.lock:
+                    server.stats['rate_limited'] = server.stats['rate_limited'] + 1
+                headers['Retry-After'] = str(max(1, int(reset + 0.5)))
+                return self.send_json(429, {'success': False, 'error': 'Rate limit exceeded'}, headers)
+
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        with server.lock:
+            error = server.error_rate > 0 and server.random.random() < server.error_rate
+            if error:
+                server.stats['errors'] = server.stats['errors'] + 1
+        if error:
+            return self.send_json(503, {'success': False, 'error': 'Service unavailable'}, headers)
+
+        if len(path) < 2 or path[0] != 'v1':
+            return self.send_json(404, {'success': False}, headers)
+
+        if path[1:] == ['users', 'me']:
+            return self.send_json(200, {'success': True, 'data': {'id': 1, 'company_id': 1, 'name': 'User 1'}}, headers)
+
+        data = get_reference_data(path[1])
+        if data is not None:
+            return self.send_json(200, {'success': True, 'data': data}, headers)
+
+        start = int(query.get('start', ['0'])[0])
+        limit = min(500, int(query.get('limit', ['100'])[0]))
+
+        if path[1] == 'recents':
+            # every tenth item changed since the given time along with the
+            # items that were updated
+            item_type = query.get('items', [''])[0]
+            entity = [name for name, e in ENTITIES.items() if e[0] == item_type]
+            if len(entity) == 0:
+                return self.send_json(400, {'success': False}, headers)
+            ids = sorted(set(range(10, server.count + 1, 10)).union(server.get_changed_ids(entity[0])))
+            data = [{'item': item_type, 'id': i, 'data': server.get_item(entity[0], i)} for i in ids[start:start+limit]]
+            return self.send_page(data, start, limit, len(ids), headers)
+
+        if path[1] not in ENTITIES:
+            return self.send_json(404, {'success': False}, headers)
+
+        item_type = ENTITIES[path[1]][0]
+        if len(path) == 3 and path[2] == 'search':
+            # matches are found by scanning the items, which is fine for the
+            # item counts used by the benchmarks
+            term = query.get('term', [''])[0]
+            fields = query.get('fields', ['name'])[0].split(',')
+            exact_match = query.get('exact_match', ['false'])[0] == 'true'
+            matches = []
+            for i in range(1, server.count + 1):
+                item = server.get_item(path[1], i)
+                if is_search_match(item, fields, term, exact_match):
+                    matches.append({'result_score': 1, 'item': {'id': i, 'type': item_type, 'name': item.get('name')}})
+            content = {'success': True, 'data': {'items': matches[start:start+limit]}, 'additional_data': {'pagination': {'start': start, 'limit': limit, 'more_items_in_collection': start + limit < len(matches)}}}
+            return self.send_json(200, content, headers)
+
+        if len(path) == 3:
+            item_id = int(path[2])
+            if item_id < 1 or item_id > server.count:
+                return self.send_json(404, {'success': False, 'error': 'Not found'}, headers)
+            return self.send_json(200, {'success': True, 'data': server.get_item(path[1], item_id)}, headers)
+
+        # deleted items keep their place in the pages so that the offsets of
+        # the other items don't change
+        data = [server.get_item(path[1], i) for i in range(start + 1, min(start + limit, server.count) + 1)]
+        data = [item for item in data if is_deleted(path[1], item) == False]
+        return self.send_page(data, start, limit, server.count, headers)
+
+    def send_page(self, data, start, limit, total, headers):
+        pagination = {'start': start, 'limit': limit, 'more_items_in_collection': start + limit < total}
+        if start + limit < total:
+            pagination['next_start'] = start + limit
+        content = {'success': True, 'data': data if len(data) > 0 else None, 'additional_data': {'pagination': pagination}}
+        return self.send_json(200, content, headers)
+
+    def send_json(self, status, content, headers):
+        body = json.dumps(content).encode('utf-8')
+        with self.server.lock:
+            self.server.stats['bytes'] = self.server.stats['bytes'] + len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_server(port=0, **kwargs):
+
+    # start the server on a background thread and return it
+    server = MockServer(('127.0.0.1', port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic Pipedrive api pages')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--count', type=int, default=1000, help='number of items for each entity')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with a 503')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests allowed per two second window')
+    args = parser.parse_args()
+
+    server = MockServer(('127.0.0.1', args.port), count=args.count, latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    print('Serving on ' + server.url)
+    server.serve_forever()
@@ -0,0 +1,64 @@
+# builds the function files from the shared engine; each pipedrive-*.py file
+# is made of its yaml header, the imports and settings of the engine, the
+# entity spec of the function and the code of the engine, and the engine
+# parts are copied from pipedrive_engine.py; run with --check to list the
+# function files that differ from the engine without changing them
+
+import os
+import sys
+import glob
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ENGINE_PATH = os.path.join(ROOT_DIR, 'pipedrive_engine.py')
+FUNCTION_PATHS = os.path.join(ROOT_DIR, 'pipedrive-*.py')
+
+SPEC_START = '# the items returned by this function'
+ENGINE_START = '# the code from here on'
+
+def get_sections(content, path):
+
+    # split a file into its header, imports and settings, entity spec and
+    # engine code
+    top_start = content.find('\nimport ') + 1
+    spec_start = content.find('\n' + SPEC_START) + 1
+    engine_start = content.find('\n' + ENGINE_START) + 1
+    if not 0 < top_start < spec_start < engine_start:
+        raise ValueError("Can't find the engine sections in '" + path + "'")
+    return content[:top_start], content[top_start:spec_start], content[spec_start:engine_start], content[engine_start:]
+
+def build(check=False):
+
+    # return the function files that differ from the engine; these are
+    # rewritten unless only checking
+    with open(ENGINE_PATH) as f:
+        engine_header, engine_top, engine_spec, engine_code = get_sections(f.read(), ENGINE_PATH)
+
+    changed = []
+    for path in sorted(glob.glob(FUNCTION_PATHS)):
+        with open(path) as f:
+            content = f.read()
+        header, top, spec, code = get_sections(content, path)
+        built = header + engine_top + spec + engine_code
+        if built == content:
+            continue
+        changed.append(path)
+        if check == False:
+            with open(path, 'w') as f:
+                f.write(built)
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy the shared engine into the function files')
+    parser.add_argument('--check', action='store_true', help='fail when a function file differs from the engine instead of updating it')
+    args = parser.parse_args()
+
+    changed = build(args.check)
+    for path in changed:
+        print(('differs: ' if args.check else 'updated: ') + os.path.relpath(path, ROOT_DIR))
+
+    if args.check and len(changed) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,24 @@
 # params:
 #   - name: properties
 #     type: array
-#     description: The properties to return (defaults to all properties). See "Returns" for a listing of the available properties.
+#     description: The properties to return (defaults to all properties except the names and emails of the activity's users and the name of its type). See "Returns" for a listing of the available properties.
 #     required: false
 #   - name: filter
 #     type: string
 #     description: Filter to apply with key/values specified as a URL query string where the keys correspond to the properties to filter.
 #     required: false
+#   - name: format
+#     type: string
+#     description: The format to return the data in; either "ndjson", "csv", "arrow" (an Arrow IPC stream) or "parquet" (defaults to "ndjson").
+#     required: false
+#   - name: compression
+#     type: string
+#     description: The compression to apply to the returned data; either "none" or "gzip" (defaults to "none"); gzip data is returned with the "application/gzip" content type.
+#     required: false
+#   - name: page_size
+#     type: integer
+#     description: The number of items to request from Pipedrive per page, up to 500 (defaults to a size that's adjusted to the response times and sizes of the pages requested).
+#     required: false
 # returns:
 #   - name: id
 #     type: integer
@@ -123,81 +135,2153 @@
 #   - name: conference_meeting_url
 #     type: string
 #     description: The conference meeting link
+#   - name: user_name
+#     type: string
+#     description: The name of the user the activity is assigned to
+#   - name: user_email
+#     type: string
+#     description: The email of the user the activity is assigned to
+#   - name: created_by_user_name
+#     type: string
+#     description: The name of the user who created the activity
+#   - name: type_name
+#     type: string
+#     description: The name of the type of the activity
 # examples:
 #   - '""'
 # ---
 
+import os
+import logging
+import email.utils
+import zlib
+import time
+import io
+import csv
 import json
+import re
 import urllib
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import asyncio
+import weakref
+import functools
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from datetime import *
-from decimal import *
-from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+
+# use a faster json library for decoding pages and encoding items when one
+# is available; the standard library is used otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# brotli lets api responses be requested with br compression in addition
+# to gzip; urllib3 decodes either when the module is available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ijson lets the items in a page be parsed as the page is read from the
+# api rather than after all of it has been read
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# fcntl locks the mirrors so that only one process updates a mirror at a
+# time; without it, updates are only serialized within the process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# pyarrow is needed for the arrow and parquet output formats
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# httpx is needed for the asyncio version of get_data
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# connection pool and compression settings for the session shared by all
+# requests; the pool has at least POOL_SIZE connections and is made larger
+# when a function requests more pages at once (see get_pool_size)
+POOL_SIZE = 10
+KEEP_ALIVE = True
+
+# seconds to wait for a connection to the api and for each read of a
+# response before the request fails, so a stalled connection doesn't hold a
+# page thread forever
+REQUEST_CONNECT_TIMEOUT = 10
+REQUEST_READ_TIMEOUT = 60
+ACCEPT_ENCODING = 'br, gzip, deflate' if brotli is not None else 'gzip, deflate'
+
+# size of the connection pool of the httpx client shared by all the calls
+# made with get_data_async on an event loop
+ASYNC_POOL_SIZE = 100
+
+# number of threads shared by all the calls made with get_data_async that
+# parse, map and encode their pages
+ASYNC_CPU_WORKERS = os.cpu_count() or 4
+
+# number of pages requested ahead of the page being returned
+PAGE_CONCURRENCY = 4
+
+# parse pages as they're read when ijson is available; the items of a page
+# are then returned as they arrive instead of once the page has been read;
+# the response is read in chunks of PAGE_CHUNK_SIZE bytes
+STREAM_PAGES = True
+PAGE_CHUNK_SIZE = 64*1024
+
+# unless a page size is given, pages are sized to take about
+# PAGE_TARGET_TIME seconds and to be about PAGE_TARGET_BYTES bytes within
+# the limits below (500 is the most the api allows); pages aren't made
+# smaller while less than PAGE_MIN_HEADROOM of the rate limit is left
+PAGE_SIZE_MIN = 50
+PAGE_SIZE_MAX = 500
+PAGE_TARGET_TIME = 5
+PAGE_TARGET_BYTES = 4*1024*1024
+PAGE_MIN_HEADROOM = 0.25
+
+# output formats and their content types; rows are written in chunks of
+# about OUTPUT_CHUNK_SIZE bytes and arrow/parquet output is built from
+# record batches of OUTPUT_BATCH_SIZE rows
+OUTPUT_FORMATS = OrderedDict([
+    ('ndjson', 'application/x-ndjson'),
+    ('csv', 'text/csv'),
+    ('arrow', 'application/vnd.apache.arrow.stream'),
+    ('parquet', 'application/vnd.apache.parquet')
+])
+OUTPUT_CHUNK_SIZE = 256*1024
+OUTPUT_BATCH_SIZE = 10000
+
+# directory for the local sqlite mirrors of the items kept by incremental
+# sync; the mirrors and the cached pages below are only accessible by the
+# user running the function
+MIRROR_DIR = os.path.join(tempfile.gettempdir(), 'flexio-pipedrive')
+
+# local cache of api pages; the cache is off unless CACHE_TTL is set to the
+# number of seconds that pages may be returned as-is, after which they're
+# revalidated with the api; the pages of a collection are only returned
+# as-is when all of them are from the same earlier request of the whole
+# collection, so the items are always a consistent snapshot; the least
+# recently used pages are removed when the cache is full
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'flexio-pipedrive', 'pages')
+CACHE_TTL = 0
+CACHE_MAX_SIZE = 256*1024*1024
+
+# identical page requests made at the same time, e.g. by calls for the same
+# connection from several users, share a single request to the api
+COALESCE_PAGES = True
+
+# related items from these api paths are small sets of reference data that
+# are kept in memory for REFERENCE_TTL seconds and shared by the calls for
+# a connection made by the same process; like the properties of any other
+# related items, the properties from these are only returned when asked for
+REFERENCE_PATHS = ['/v1/users', '/v1/pipelines', '/v1/stages', '/v1/activityTypes']
+REFERENCE_TTL = 300
+
+# keys passed with the lookup param are resolved LOOKUP_CONCURRENCY at a
+# time with up to LOOKUP_MAX_MATCHES items returned for each key; the items
+# found for a key are kept in memory for LOOKUP_TTL seconds and shared by
+# the calls for a connection made by the same process, up to
+# LOOKUP_MAX_KEYS keys; the rows returned start with the key they're for
+# in the LOOKUP_KEY column
+LOOKUP_CONCURRENCY = 8
+LOOKUP_MAX_MATCHES = 10
+LOOKUP_TTL = 300
+LOOKUP_MAX_KEYS = 10000
+LOOKUP_KEY = 'lookup_key'
+
+# a summary of the timings, requests, pages, rows and bytes of each call is
+# logged when METRICS_LOG is set and written in the prometheus text format
+# to a file in METRICS_DIR when it's set (e.g. the directory read by the
+# node exporter textfile collector)
+METRICS_LOG = True
+METRICS_DIR = None
+
+# requests for a connection are paced to stay under the rate limit reported
+# by the api; the window is the period the reported limit applies to and
+# requests that are rate limited anyway are retried up to the given number
+# of times after the delay given by the api
+RATE_LIMIT_WINDOW = 2
+RATE_LIMIT_RETRIES = 5
+
+# the items returned by this function; see here for more info:
+# https://developers.pipedrive.com/docs/api/v1/#!/Activities/get_activities
+ITEM_PATH = '/v1/activities'
+ITEM_QUERY_PARAMS = {
+    'user_id': 0 # return all activities that the user has access to, not just activity for a specific user
+}
+
+# a row is returned for each item
+ITEM_DETAILS = None
+
+# activity isn't available from the recents endpoint, so incremental sync
+# isn't supported
+RECENTS_ITEM = None
+
+# related items that properties can be looked up in; each maps the path of
+# the related item's id in an item to the api path and query params of the
+# related items, optionally followed by the key the related items are
+# looked up by (defaults to 'id'); the related items are requested in full
+# when a property from them is requested
+JOINS = OrderedDict([
+    ('user', ('user_id', '/v1/users', {})),
+    ('created_by_user', ('created_by_user_id', '/v1/users', {})),
+    ('activity_type', ('type', '/v1/activityTypes', {}, 'key_string'))
+])
+
+# properties that are indexed in the local mirror kept by incremental sync
+MIRROR_INDEXES = []
+
+# fields that items can be looked up by with the lookup param; each maps
+# to the field matched by the api search, or None for the item id
+LOOKUP_FIELDS = OrderedDict()
+
+# map this function's property names to the API's property names and types
+PROPERTIES = OrderedDict([
+    ('id', ('id', 'integer')),
+    ('user_id', ('user_id', 'integer')),
+    ('created_by_user_id', ('created_by_user_id', 'integer')),
+    ('org_id', ('org_id', 'integer')),
+    ('org_name', ('org_name', 'string')),
+    ('person_id', ('person_id', 'integer')),
+    ('person_name', ('person_name', 'string')),
+    ('lead_id', ('lead_id', 'integer')),
+    ('lead_title', ('lead_title', 'string')),
+    ('deal_id', ('deal_id', 'integer')),
+    ('deal_title', ('deal_title', 'string')),
+    ('subject', ('subject', 'string')),
+    ('type', ('type', 'string')),
+    ('done', ('done', 'boolean')),
+    ('marked_as_done_time', ('marked_as_done_time', 'string')),
+    ('due_date', ('due_date', 'string')),
+    ('due_time', ('due_time', 'string')),
+    ('duration', ('duration', 'string')),
+    ('add_time', ('add_time', 'string')),
+    ('update_time', ('update_time', 'string')),
+    ('last_notification_time', ('last_notification_time', 'string')),
+    ('busy_flag', ('busy_flag', 'string')),
+    ('public_description', ('public_description', 'string')),
+    ('note', ('note', 'string')),
+    ('location_subpremise', ('location_subpremise', 'string')),
+    ('location_street_number', ('location_street_number', 'string')),
+    ('location_route', ('location_route', 'string')),
+    ('location_sublocality', ('location_sublocality', 'string')),
+    ('location_locality', ('location_locality', 'string')),
+    ('location_admin_area_level_1', ('location_admin_area_level_1', 'string')),
+    ('location_admin_area_level_2', ('location_admin_area_level_2', 'string')),
+    ('location_country', ('location_country', 'string')),
+    ('location_postal_code', ('location_postal_code', 'string')),
+    ('location_formatted_address', ('location_formatted_address', 'string')),
+    ('conference_meeting_client', ('conference_meeting_client', 'string')),
+    ('conference_meeting_url', ('conference_meeting_url', 'string')),
+    ('user_name', ('user.name', 'string')),
+    ('user_email', ('user.email', 'string')),
+    ('created_by_user_name', ('created_by_user.name', 'string')),
+    ('type_name', ('activity_type.name', 'string'))
+])
+
+# filter keys that can be passed through to the api query; keys that aren't
+# properties (e.g. filter_id) are only used in the api query
+FILTER_PARAMS = OrderedDict([
+    ('user_id', 'user_id'),
+    ('type', 'type'),
+    ('done', 'done'),
+    ('filter_id', 'filter_id'),
+    ('start_date', 'start_date'),
+    ('end_date', 'end_date')
+])
+
+# the code from here on, along with the imports and settings above the
+# entity spec, is built from pipedrive_engine.py by build.py; edit it there
 
 # main function entry point
-def flexio_handler(flex):
+def flexio_handler(flex, metrics=None):
 
-    flex.output.content_type = 'application/x-ndjson'
-    for data in get_data(flex.vars):
+    # the timings and counts of the call are recorded in the given metrics
+    # when there are any
+    flex.output.content_type = get_content_type(flex.vars)
+    api_base_uri, headers = get_connection(flex.vars)
+    metrics = metrics if metrics is not None else Metrics()
+    for data in get_data(flex.vars, metrics):
+        start = time.perf_counter()
         flex.output.write(data)
+        metrics.add_time('write', time.perf_counter() - start)
+        metrics.add_count('bytes_out', len(data))
+    report_metrics(api_base_uri, metrics)
 
-def get_data(params):
+def get_data(params, metrics=None):
 
-    # get the api key and company domain from the variable input
-    auth_token = dict(params).get('pipedrive_connection',{}).get('access_token')
-    api_base_uri = dict(params).get('pipedrive_connection',{}).get('api_base_uri')
+    # the rows of each page of items are mapped and encoded as the page
+    # arrives; the output is returned in chunks as it's encoded
+    params = dict(params)
+    metrics = metrics if metrics is not None else Metrics()
+    encoder = get_encoder(params, metrics)
+    pages, get_item_rows = get_item_source(params, metrics)
+    for data in pages:
+        chunk = encode_items(encoder, data, get_item_rows, metrics)
+        if len(chunk) > 0:
+            yield chunk
+    chunk = encoder.close()
+    if len(chunk) > 0:
+        yield chunk
 
-    # see here for more info:
-    # https://developers.pipedrive.com/docs/api/v1/#!/Activities/get_activities
-    # https://pipedrive.readme.io/docs/core-api-concepts-pagination
+async def get_data_async(params, metrics=None):
+
+    # asyncio version of get_data; all of the requests of a call, including
+    # those for related items, lookups and the mirror, are made on the event
+    # loop with a pooled httpx client, so a single worker can drive the
+    # requests of many calls and connections at once; parsing, mapping and
+    # encoding the pages is cpu work that's done on the threads shared by
+    # all of the calls (see run_on_cpu)
+    if httpx is None:
+        raise ValueError("get_data_async requires httpx")
+
+    params = dict(params)
+    api_base_uri, headers = get_connection(params)
+    metrics = metrics if metrics is not None else Metrics()
+    encoder = get_encoder(params, metrics)
+    pages, get_item_rows = await get_item_source_async(params, metrics)
+    try:
+        async for data in pages:
+            chunk = await run_on_cpu(encode_items, encoder, data, get_item_rows, metrics)
+            if len(chunk) > 0:
+                metrics.add_count('bytes_out', len(chunk))
+                yield chunk
+        chunk = await run_on_cpu(encoder.close)
+        if len(chunk) > 0:
+            metrics.add_count('bytes_out', len(chunk))
+            yield chunk
+        report_metrics(api_base_uri, metrics)
+    finally:
+        await pages.aclose()
+
+def encode_items(encoder, data, get_item_rows, metrics):
+
+    # the time spent mapping and filtering is added up per page
+    rows = []
+    map_time = 0
+    for item in data:
+        start = time.perf_counter()
+        rows.extend(get_item_rows(item))
+        map_time = map_time + time.perf_counter() - start
+
+    metrics.add_time('map', map_time)
+    metrics.add_count('rows', len(rows))
+    return encoder.write(rows)
+
+def get_encoder(params, metrics):
+    output_format = get_output_format(params)
+    if get_layout(params) == 'nested' and output_format != 'ndjson':
+        raise ValueError("The nested layout is only available for the 'ndjson' format")
+    properties = get_properties(params)
+    if get_lookup(params) is not None:
+        properties = [LOOKUP_KEY] + properties
+
+    if output_format == 'csv':
+        encoder = CsvEncoder(properties, metrics)
+    elif output_format in ('arrow', 'parquet'):
+        encoder = ArrowEncoder(properties, output_format, metrics)
+    else:
+        encoder = NdjsonEncoder(metrics)
+
+    if get_output_compression(params) == 'gzip':
+        encoder = GzipEncoder(encoder, metrics)
+    return encoder
+
+def get_output_format(params):
+    output_format = (dict(params).get('format') or 'ndjson').strip().lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Invalid format: '" + output_format + "'")
+    if output_format in ('arrow', 'parquet') and pyarrow is None:
+        raise ValueError("The '" + output_format + "' format requires pyarrow")
+    return output_format
+
+def get_output_compression(params):
+    compression = (dict(params).get('compression') or 'none').strip().lower()
+    if compression not in ('none', 'gzip'):
+        raise ValueError("Invalid compression: '" + compression + "'")
+    return compression
+
+def get_content_type(params):
+
+    # gzip output is served as gzip rather than as the format it contains,
+    # since a client taking it as ndjson or csv would read compressed bytes
+    if get_output_compression(params) == 'gzip':
+        return 'application/gzip'
+    return OUTPUT_FORMATS[get_output_format(params)]
+
+class GzipEncoder:
+
+    # compresses the output of another encoder as it's written rather than
+    # all at once
+    def __init__(self, encoder, metrics):
+        self.encoder = encoder
+        self.metrics = metrics
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, items):
+        return self.compress(self.encoder.write(items))
+
+    def close(self):
+        return self.compress(self.encoder.close()) + self.compressor.flush()
+
+    def compress(self, data):
+        start = time.perf_counter()
+        data = self.compressor.compress(data)
+        self.metrics.add_time('encode', time.perf_counter() - start)
+        return data
+
+class NdjsonEncoder:
+
+    # encodes the items into a reusable buffer that's returned once it holds
+    # about OUTPUT_CHUNK_SIZE bytes rather than building a string per page
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.buffer = bytearray()
+
+    def write(self, items):
+        start = time.perf_counter()
+        for item in items:
+            self.buffer += json_dumps(item)
+            self.buffer += b"\n"
+        self.metrics.add_time('encode', time.perf_counter() - start)
+        if len(self.buffer) < OUTPUT_CHUNK_SIZE:
+            return b''
+        return self.read()
+
+    def close(self):
+        return self.read()
+
+    def read(self):
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+class CsvEncoder:
+
+    # the property names are only written once in the header row; booleans
+    # are written as they are in json rather than as True and False
+    def __init__(self, properties, metrics):
+        self.metrics = metrics
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(properties)
+
+    def write(self, items):
+        start = time.perf_counter()
+        for item in items:
+            self.writer.writerow(['true' if v is True else 'false' if v is False else v for v in item.values()])
+        self.metrics.add_time('encode', time.perf_counter() - start)
+        if self.buffer.tell() < OUTPUT_CHUNK_SIZE:
+            return b''
+        return self.read()
+
+    def close(self):
+        return self.read()
+
+    def read(self):
+        data = self.buffer.getvalue().encode('utf-8')
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+class ArrowEncoder:
+
+    # the schema is taken from the property types so that every record
+    # batch has the same schema regardless of the values in it; the key of
+    # a lookup is a string; the items are written in record batches of
+    # OUTPUT_BATCH_SIZE items
+    def __init__(self, properties, output_format, metrics):
+        self.metrics = metrics
+        self.schema = pyarrow.schema([(p, ARROW_TYPES[PROPERTIES[p][1] if p != LOOKUP_KEY else 'string']) for p in properties])
+        self.sink = OutputSink()
+        if output_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+        self.batch = []
+
+    def write(self, items):
+        self.batch.extend(items)
+        start = time.perf_counter()
+        while len(self.batch) >= OUTPUT_BATCH_SIZE:
+            self.writer.write_table(get_arrow_table(self.batch[:OUTPUT_BATCH_SIZE], self.schema))
+            del self.batch[:OUTPUT_BATCH_SIZE]
+        self.metrics.add_time('encode', time.perf_counter() - start)
+        return self.sink.read()
+
+    def close(self):
+        start = time.perf_counter()
+        if len(self.batch) > 0:
+            self.writer.write_table(get_arrow_table(self.batch, self.schema))
+            self.batch = []
+        self.writer.close()
+        self.metrics.add_time('encode', time.perf_counter() - start)
+        return self.sink.read()
+
+def get_arrow_table(items, schema):
+    columns = []
+    for field in schema:
+        values = [item[field.name] for item in items]
+        try:
+            columns.append(pyarrow.array(values, type=field.type))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError, OverflowError):
+            # the api doesn't always return the documented type, so convert
+            # the values when they can't be used as-is
+            convert = ARROW_CONVERTERS[str(field.type)]
+            columns.append(pyarrow.array([to_arrow_value(v, convert, field) for v in values], type=field.type))
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+def to_arrow_value(value, convert, field):
+
+    # a value that doesn't convert to the type of its property is an error
+    # rather than being returned as null
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError, KeyError, OverflowError):
+        raise ValueError("Can't convert the value '" + to_arrow_string(value) + "' of '" + field.name + "' to " + str(field.type))
+
+def to_arrow_integer(value):
+    number = float(value)
+    if number.is_integer() == False:
+        raise ValueError(value)
+    return int(number)
+
+def to_arrow_string(value):
+    if isinstance(value, str):
+        return value
+    return json_dumps(value).decode('utf-8')
+
+def to_arrow_boolean(value):
+    if isinstance(value, str):
+        return {'true': True, '1': True, 'false': False, '0': False}[value.strip().lower()]
+    return bool(value)
+
+if pyarrow is not None:
+    ARROW_TYPES = {
+        'integer': pyarrow.int64(),
+        'number': pyarrow.float64(),
+        'boolean': pyarrow.bool_(),
+        'string': pyarrow.string()
+    }
+    ARROW_CONVERTERS = {
+        'int64': to_arrow_integer,
+        'double': float,
+        'bool': to_arrow_boolean,
+        'string': to_arrow_string
+    }
+
+class OutputSink:
+
+    # file-like object the arrow writers write to; the data written so far
+    # is handed off with read() while the position keeps counting from the
+    # start of the output, which the parquet writer relies on
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.position = self.position + len(data)
+        return len(data)
+
+    def read(self):
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def get_connection(params):
+
+    # get the api key and company domain from the variable input
+    params = dict(params)
+    auth_token = params.get('pipedrive_connection',{}).get('access_token')
+    api_base_uri = params.get('pipedrive_connection',{}).get('api_base_uri')
 
     headers = {
         'Authorization': 'Bearer ' + auth_token
     }
-    url = api_base_uri + '/v1/activities'
+    return api_base_uri, headers
 
-    page_size = 500
-    page_cursor_id = None
-    while True:
+class ItemQuery:
 
-        url_query_params = {
-            'limit': page_size,
-            'user_id': 0 # return all activities that the user has access to, not just activity for a specific user
-        }
+    # the items asked for by the params of a call: the properties returned,
+    # the conditions on them and whether the items come from a lookup, the
+    # mirror or the api
+    def __init__(self, params):
+        params = dict(params)
+        self.api_base_uri, self.headers = get_connection(params)
+        self.url = self.api_base_uri + ITEM_PATH
 
-        if page_cursor_id is not None:
-            url_query_params['start'] = page_cursor_id
-        url_query_str = urllib.parse.urlencode(url_query_params)
-        page_url = url + '?' + url_query_str
+        sync = (params.get('sync') or 'full').strip().lower()
+        if sync not in ('full', 'incremental'):
+            raise ValueError("Invalid sync value: '" + sync + "'")
 
-        response = requests_retry_session().get(page_url, headers=headers)
+        self.page_size = get_page_size(params)
+        self.nested = get_layout(params) == 'nested'
+        self.lookup = get_lookup(params)
+        self.properties = get_properties(params)
+        self.conditions = get_filter(params)
+
+        # the filter is checked by the extractor, which looks up the properties
+        # the filter needs without returning them
+        filter_properties = [p for p in self.conditions.keys() if p in PROPERTIES and p not in self.properties]
+        self.join_properties = self.properties + filter_properties
+
+        self.url_query_params = OrderedDict(ITEM_QUERY_PARAMS)
+        self.url_query_params.update(get_filter_query_params(self.conditions))
+
+        # conditions on keys that aren't properties can only be applied by the
+        # api query, so these are always requested in full
+        if self.lookup is not None:
+            for key in self.conditions.keys():
+                if key not in PROPERTIES:
+                    raise ValueError("The filter property '" + key + "' can't be used with a lookup")
+        self.mirror = self.lookup is None and sync == 'incremental' and RECENTS_ITEM is not None and all(p in PROPERTIES for p in self.conditions.keys())
+
+    def get_extractor(self, joined_items):
+        get_item_rows = get_item_extractor(self.properties, self.conditions, joined_items, self.nested)
+        if self.lookup is not None:
+            get_item_rows = get_lookup_extractor(get_item_rows, self.properties)
+        return get_item_rows
+
+def get_item_source(params, metrics):
+
+    # returns the pages of items for a call along with the function mapping
+    # each item of a page to its rows
+    # see here for more info:
+    # https://pipedrive.readme.io/docs/core-api-concepts-pagination
+    query = ItemQuery(params)
+    joined_items = get_joined_items(query.api_base_uri, query.headers, metrics, query.join_properties, query.page_size)
+    if query.lookup is not None:
+        pages = get_lookup_pages(query.url, query.headers, metrics, *query.lookup)
+    elif query.mirror:
+        pages = get_mirror_pages(query.api_base_uri, query.url, query.headers, metrics, query.conditions, query.page_size)
+    else:
+        pages = get_item_pages(query.url, query.url_query_params, query.headers, metrics, query.page_size)
+    return pages, query.get_extractor(joined_items)
+
+async def get_item_source_async(params, metrics):
+    query = ItemQuery(params)
+    joined_items = await get_joined_items_async(query.api_base_uri, query.headers, metrics, query.join_properties, query.page_size)
+    if query.lookup is not None:
+        pages = get_lookup_pages_async(query.url, query.headers, metrics, *query.lookup)
+    elif query.mirror:
+        pages = get_mirror_pages_async(query.api_base_uri, query.url, query.headers, metrics, query.conditions, query.page_size)
+    else:
+        pages = get_item_pages_async(query.url, query.url_query_params, query.headers, metrics, query.page_size)
+    return pages, query.get_extractor(joined_items)
+
+def get_layout(params):
+
+    # the nested layout returns a row per item with its details in a list
+    # rather than a row per detail
+    layout = (dict(params).get('layout') or 'flat').strip().lower()
+    if layout not in ('flat', 'nested') or (layout == 'nested' and ITEM_DETAILS is None):
+        raise ValueError("Invalid layout: '" + layout + "'")
+    return layout
+
+def get_page_size(params):
+    page_size = dict(params).get('page_size')
+    if page_size is None or page_size == '':
+        return None
+    try:
+        page_size = int(page_size)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page size: '" + str(page_size) + "'")
+    if page_size < 1 or page_size > PAGE_SIZE_MAX:
+        raise ValueError("Invalid page size: '" + str(page_size) + "'")
+    return page_size
+
+def get_lookup(params):
+
+    # keys may be passed as an array or as a string delimited by commas or
+    # line breaks; the field the keys are looked up by is picked for each
+    # key unless it's given
+    keys = params.get('lookup') or []
+    if isinstance(keys, str):
+        keys = keys.replace('\n', ',').split(',')
+    keys = [str(k).strip() for k in keys]
+    keys = [k for k in keys if len(k) > 0]
+    if len(keys) == 0:
+        return None
+
+    if len(LOOKUP_FIELDS) == 0:
+        raise ValueError("Lookups aren't available for " + ITEM_PATH)
+
+    lookup_by = (params.get('lookup_by') or 'auto').strip().lower()
+    if lookup_by != 'auto' and lookup_by not in LOOKUP_FIELDS:
+        raise ValueError("Invalid lookup_by value: '" + lookup_by + "'")
+    return keys, lookup_by
+
+def get_lookup_field(key, lookup_by):
+
+    # digits alone are taken as an id, so phone numbers are only recognized
+    # when they're written with a leading '+' or with separators
+    if lookup_by != 'auto':
+        return lookup_by
+    if key.isdigit() and 'id' in LOOKUP_FIELDS:
+        return 'id'
+    if LOOKUP_PHONE_PATTERN.match(key) and 'phone' in LOOKUP_FIELDS:
+        return 'phone'
+    if '@' in key and 'email' in LOOKUP_FIELDS:
+        return 'email'
+    return 'name'
+
+LOOKUP_PHONE_PATTERN = re.compile(r'^(\+[\d\s\-().]*\d|[\d(][\d\s\-().]*[\s\-().][\d\s\-().]*\d)$')
+
+def get_lookup_pages(url, headers, metrics, keys, lookup_by):
+
+    # each distinct key is only resolved once and the keys are resolved at
+    # the same time; the items found are returned in the order of the keys
+    # as a page per key holding the key and its items
+    lookups = get_lookups(keys, lookup_by)
+    executor = ThreadPoolExecutor(max_workers=LOOKUP_CONCURRENCY)
+    futures = {}
+    try:
+        for lookup, key in lookups.items():
+            futures[lookup] = executor.submit(lookup_items, url, headers, metrics, lookup[0], key)
+        for key in keys:
+            yield [(key, futures[(get_lookup_field(key, lookup_by), key.lower())].result())]
+    finally:
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+async def get_lookup_pages_async(url, headers, metrics, keys, lookup_by):
+
+    # same as get_lookup_pages with the keys resolved as tasks on the event
+    # loop, LOOKUP_CONCURRENCY at a time
+    lookups = get_lookups(keys, lookup_by)
+    semaphore = asyncio.Semaphore(LOOKUP_CONCURRENCY)
+
+    async def lookup_items_when_ready(field, key):
+        async with semaphore:
+            return await lookup_items_async(url, headers, metrics, field, key)
+
+    tasks = {}
+    try:
+        for lookup, key in lookups.items():
+            tasks[lookup] = asyncio.ensure_future(lookup_items_when_ready(lookup[0], key))
+        for key in keys:
+            yield [(key, await tasks[(get_lookup_field(key, lookup_by), key.lower())])]
+    finally:
+        for task in tasks.values():
+            task.cancel()
+            task.add_done_callback(discard_task)
+
+def get_lookups(keys, lookup_by):
+    lookups = OrderedDict()
+    for key in keys:
+        lookups.setdefault((get_lookup_field(key, lookup_by), key.lower()), key)
+    return lookups
+
+def get_lookup_extractor(get_item_rows, properties):
+
+    # the rows of a lookup start with the key they were found for, and a key
+    # without any matching rows returns a row with only the key so that
+    # there's a row for each key
+    empty_row = dict((p, None) for p in properties)
+
+    def get_lookup_rows(lookup):
+        key, items = lookup
+        rows = [{LOOKUP_KEY: key, **row} for item in items for row in get_item_rows(item)]
+        if len(rows) == 0:
+            rows.append({LOOKUP_KEY: key, **empty_row})
+        return rows
+
+    return get_lookup_rows
+
+lookup_items_lock = threading.Lock()
+lookup_items_memo = OrderedDict()
+
+def lookup_items(url, headers, metrics, field, key):
+
+    # the items found are kept per access token, the same as cached pages
+    memo_key = (url, field, key.lower(), headers.get('Authorization', ''))
+    items = get_lookup_memo(memo_key)
+    if items is not None:
+        return items
+
+    # search for the ids of the items matching the key and then request the
+    # items themselves, since search results only include a few fields
+    if LOOKUP_FIELDS[field] is None:
+        item_ids = [key] if key.isdigit() else []
+    else:
+        response = send_request(get_search_url(url, field, key), headers, metrics)
         response.raise_for_status()
-        content = response.json()
-        data = content.get('data',[])
+        item_ids = get_search_item_ids(response.content)
 
-        if len(data) == 0: # sanity check in case there's an issue with cursor
-            break
+    items = []
+    for item_id in item_ids[:LOOKUP_MAX_MATCHES]:
+        response = send_request(url + '/' + str(item_id), headers, metrics)
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        item = json_loads(response.content).get('data')
+        if item is not None:
+            items.append(item)
+
+    set_lookup_memo(memo_key, items)
+    return items
+
+async def lookup_items_async(url, headers, metrics, field, key):
+
+    # same as lookup_items; both share the items found
+    memo_key = (url, field, key.lower(), headers.get('Authorization', ''))
+    items = get_lookup_memo(memo_key)
+    if items is not None:
+        return items
+
+    if LOOKUP_FIELDS[field] is None:
+        item_ids = [key] if key.isdigit() else []
+    else:
+        response = await send_request_async(get_search_url(url, field, key), headers, metrics)
+        response.raise_for_status()
+        item_ids = get_search_item_ids(response.content)
+
+    items = []
+    for item_id in item_ids[:LOOKUP_MAX_MATCHES]:
+        response = await send_request_async(url + '/' + str(item_id), headers, metrics)
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        item = json_loads(response.content).get('data')
+        if item is not None:
+            items.append(item)
+
+    set_lookup_memo(memo_key, items)
+    return items
+
+def get_search_url(url, field, key):
+    query_params = OrderedDict([('term', key), ('fields', LOOKUP_FIELDS[field]), ('exact_match', 'true'), ('limit', LOOKUP_MAX_MATCHES)])
+    return url + '/search?' + urllib.parse.urlencode(query_params)
+
+def get_search_item_ids(content):
+    results = (json_loads(content).get('data') or {}).get('items') or []
+    return [r.get('item', {}).get('id') for r in results]
+
+def get_lookup_memo(memo_key):
+    with lookup_items_lock:
+        update_time, items = lookup_items_memo.get(memo_key, (None, None))
+    if update_time is not None and time.monotonic() - update_time < LOOKUP_TTL:
+        return items
+    return None
+
+def set_lookup_memo(memo_key, items):
+    with lookup_items_lock:
+        lookup_items_memo.pop(memo_key, None)
+        lookup_items_memo[memo_key] = (time.monotonic(), items)
+        while len(lookup_items_memo) > LOOKUP_MAX_KEYS:
+            lookup_items_memo.popitem(last=False)
+
+def get_joined_items(api_base_uri, headers, metrics, properties, page_size=None):
+
+    # the related items used by the properties are requested at the same
+    # time and indexed by their key; only the fields used by the properties
+    # are kept for each related item unless it's reference data
+    fields = get_joined_fields(properties)
+    if len(fields) == 0:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(fields)) as executor:
+        futures = []
+        for join, keys in fields.items():
+            if JOINS[join][1] in REFERENCE_PATHS:
+                futures.append((join, executor.submit(get_reference_index, api_base_uri, headers, metrics, join)))
+            else:
+                futures.append((join, executor.submit(get_item_index, api_base_uri, headers, metrics, join, keys, page_size)))
+        return {join: future.result() for join, future in futures}
+
+async def get_joined_items_async(api_base_uri, headers, metrics, properties, page_size=None):
+
+    # same as get_joined_items with the related items requested as tasks on
+    # the event loop
+    fields = get_joined_fields(properties)
+    indexes = []
+    for join, keys in fields.items():
+        if JOINS[join][1] in REFERENCE_PATHS:
+            indexes.append(get_reference_index_async(api_base_uri, headers, metrics, join))
+        else:
+            indexes.append(get_item_index_async(api_base_uri, headers, metrics, join, keys, page_size))
+    return dict(zip(fields.keys(), await asyncio.gather(*indexes)))
+
+def get_joined_fields(properties):
+    fields = OrderedDict()
+    for p in properties:
+        path = PROPERTIES[p][0].split('.')
+        if path[0] in JOINS:
+            fields.setdefault(path[0], set()).add(path[1].split('[')[0])
+    return fields
+
+def get_item_index(api_base_uri, headers, metrics, join, keys=None, page_size=None):
+    key_path, item_path, query_params, item_key = (JOINS[join] + ('id',))[:4]
+    if item_path in REFERENCE_PATHS:
+        pages = get_unpaginated_pages(api_base_uri + item_path, query_params, headers, metrics)
+    else:
+        pages = get_item_pages(api_base_uri + item_path, query_params, headers, metrics, page_size)
+
+    index = {}
+    for data in pages:
+        add_to_index(index, data, item_key, keys)
+    return index
+
+async def get_item_index_async(api_base_uri, headers, metrics, join, keys=None, page_size=None):
+    key_path, item_path, query_params, item_key = (JOINS[join] + ('id',))[:4]
+    if item_path in REFERENCE_PATHS:
+        pages = get_unpaginated_pages_async(api_base_uri + item_path, query_params, headers, metrics)
+    else:
+        pages = get_item_pages_async(api_base_uri + item_path, query_params, headers, metrics, page_size)
+
+    index = {}
+    async for data in pages:
+        await run_on_cpu(add_to_index, index, data, item_key, keys)
+    return index
+
+def add_to_index(index, data, item_key, keys=None):
+    for item in data:
+        index[item.get(item_key)] = item if keys is None else {k: item.get(k) for k in keys}
+
+reference_items_lock = threading.Lock()
+reference_items = {}
+
+def get_reference_index(api_base_uri, headers, metrics, join):
+
+    # reference data is kept per access token, the same as cached pages
+    key = get_reference_key(api_base_uri, headers, join)
+    index = get_reference_memo(key)
+    if index is not None:
+        return index
+
+    index = get_item_index(api_base_uri, headers, metrics, join)
+    with reference_items_lock:
+        reference_items[key] = (time.monotonic(), index)
+    return index
+
+async def get_reference_index_async(api_base_uri, headers, metrics, join):
+
+    # same as get_reference_index; both share the reference data
+    key = get_reference_key(api_base_uri, headers, join)
+    index = get_reference_memo(key)
+    if index is not None:
+        return index
+
+    index = await get_item_index_async(api_base_uri, headers, metrics, join)
+    with reference_items_lock:
+        reference_items[key] = (time.monotonic(), index)
+    return index
+
+def get_reference_key(api_base_uri, headers, join):
+    key_path, item_path, query_params, item_key = (JOINS[join] + ('id',))[:4]
+    return (api_base_uri + item_path, urllib.parse.urlencode(sorted(query_params.items())), item_key, headers.get('Authorization', ''))
+
+def get_reference_memo(key):
+    with reference_items_lock:
+        update_time, index = reference_items.get(key, (None, None))
+    if update_time is not None and time.monotonic() - update_time < REFERENCE_TTL:
+        return index
+    return None
+
+def get_item_pages(url, query_params, headers, metrics, page_size=None):
+    for page in get_pages(url, query_params, headers, metrics, page_size):
+        yield page.items
+
+async def get_item_pages_async(url, query_params, headers, metrics, page_size=None):
+    async for page in get_pages_async(url, query_params, headers, metrics, page_size):
+        yield page.items
+
+def get_unpaginated_pages(url, query_params, headers, metrics):
+
+    # reference data isn't paginated by the api, so all of it is requested
+    # in a single request without a start or limit
+    page = get_page(url, query_params, headers, metrics)
+    try:
+        yield page.items
+        metrics.add_page(page)
+    finally:
+        page.close()
+
+async def get_unpaginated_pages_async(url, query_params, headers, metrics):
+    page = await get_page_async(url, query_params, headers, metrics)
+    yield page.items
+    metrics.add_page(page)
+
+def get_mirror_pages(api_base_uri, url, headers, metrics, conditions, page_size=None):
+
+    # items are kept in a local sqlite mirror that's updated with the items
+    # changed since the last call and then queried for the items to return;
+    # conditions on the properties in MIRROR_INDEXES are answered by the
+    # mirror's indexes and all conditions are still checked for each item;
+    # the mirror is only locked while it's updated, so a call that starts
+    # during an update waits for it and then only requests the items that
+    # changed since
+    path = get_mirror_path(api_base_uri, headers, metrics)
+    with MirrorLock(path):
+        connection = open_mirror(path)
+        try:
+            update_mirror(connection, api_base_uri, url, headers, metrics, page_size)
+        except BaseException:
+            connection.close()
+            raise
+    try:
+        query, query_params = get_mirror_query(conditions)
+        cursor = connection.execute(query, query_params)
+        while True:
+            data = read_mirror_page(cursor)
+            if len(data) == 0:
+                break
+            yield data
+    finally:
+        connection.close()
+
+async def get_mirror_pages_async(api_base_uri, url, headers, metrics, conditions, page_size=None):
+
+    # same as get_mirror_pages; the mirror is read and written on the cpu
+    # threads rather than on the event loop, and the lock is waited on by
+    # a thread of the loop's default executor
+    path = await get_mirror_path_async(api_base_uri, headers, metrics)
+    lock = MirrorLock(path)
+    await lock.acquire_async()
+    try:
+        connection = await run_on_cpu(open_mirror, path)
+        try:
+            await update_mirror_async(connection, api_base_uri, url, headers, metrics, page_size)
+        except BaseException:
+            connection.close()
+            raise
+    finally:
+        lock.release()
+    try:
+        query, query_params = get_mirror_query(conditions)
+        cursor = await run_on_cpu(connection.execute, query, query_params)
+        while True:
+            data = await run_on_cpu(read_mirror_page, cursor)
+            if len(data) == 0:
+                break
+            yield data
+    finally:
+        connection.close()
+
+def read_mirror_page(cursor):
+    return [json_loads(row[0]) for row in cursor.fetchmany(PAGE_SIZE_MAX)]
+
+def get_mirror_path(api_base_uri, headers, metrics):
+
+    # mirrors are kept per user and company rather than per access token
+    # so they remain valid when the token for the connection is refreshed
+    response = send_request(api_base_uri + '/v1/users/me', headers, metrics)
+    response.raise_for_status()
+    return get_user_mirror_path(api_base_uri, response.content)
+
+async def get_mirror_path_async(api_base_uri, headers, metrics):
+    response = await send_request_async(api_base_uri + '/v1/users/me', headers, metrics)
+    response.raise_for_status()
+    return get_user_mirror_path(api_base_uri, response.content)
+
+def get_user_mirror_path(api_base_uri, content):
+    user = json_loads(content).get('data') or {}
+    key = api_base_uri + '|' + str(user.get('company_id')) + '|' + str(user.get('id')) + '|' + RECENTS_ITEM
+    return os.path.join(MIRROR_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.sqlite')
+
+mirror_locks_lock = threading.Lock()
+mirror_locks = weakref.WeakValueDictionary()
+
+class MirrorLock:
+
+    # serializes the updates of a mirror; threads wait on a lock for each
+    # mirror and processes on a lock file next to it, and neither waits
+    # with a timeout since the first update of a large mirror can take a
+    # while
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        with mirror_locks_lock:
+            self.lock = mirror_locks.get(self.path)
+            if self.lock is None:
+                self.lock = threading.Lock()
+                mirror_locks[self.path] = self.lock
+        self.lock.acquire()
+        self.fd = None
+        try:
+            make_private_dir(os.path.dirname(self.path))
+            self.fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.release()
+            raise
+
+    async def acquire_async(self):
+
+        # a lock that's only acquired after the caller stopped waiting for it
+        # is released right away
+        future = asyncio.get_running_loop().run_in_executor(None, self.acquire)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self.release_acquired)
+            raise
+
+    def release_acquired(self, future):
+        if future.cancelled() == False and future.exception() is None:
+            self.release()
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.lock.release()
 
-        buffer = ''
+def open_mirror(path):
+
+    # each item is stored as json along with the text of its indexed
+    # properties as they're compared by the filter; the mirror is rebuilt
+    # when the indexed properties change; a connection may be used by any
+    # thread, one at a time, so get_data_async can use it from the cpu
+    # threads
+    make_private_dir(os.path.dirname(path))
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    os.chmod(path, 0o600)
+    connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+
+    columns = ['update_time'] + MIRROR_INDEXES
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS mirror_info (key TEXT PRIMARY KEY, value TEXT)')
+        row = connection.execute("SELECT value FROM mirror_info WHERE key = 'columns'").fetchone()
+        if row is None or row[0] != ','.join(columns):
+            connection.execute('DROP TABLE IF EXISTS items')
+            connection.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, item BLOB NOT NULL, ' + ', '.join('"' + c + '" TEXT' for c in columns) + ')')
+            for c in columns:
+                connection.execute('CREATE INDEX "items_' + c + '" ON items ("' + c + '")')
+            connection.execute("INSERT OR REPLACE INTO mirror_info (key, value) VALUES ('columns', ?)", (','.join(columns),))
+    return connection
+
+def update_mirror(connection, api_base_uri, url, headers, metrics, page_size=None):
+
+    # the items changed since the latest update time in the mirror are
+    # requested from the recents endpoint; the first call for a connection
+    # requests all items; the items are staged in a temporary table as
+    # they arrive and the changes are applied in a single short transaction
+    # at the end, so the mirror isn't locked while the pages are requested
+    # and an interrupted update leaves the mirror as it was; the mirror is
+    # locked by the caller
+    # see here for more info:
+    # https://developers.pipedrive.com/docs/api/v1/#!/Recents/getRecents
+    update = MirrorUpdate(connection, api_base_uri, url)
+    try:
+        for data in get_item_pages(update.url, update.query_params, headers, metrics, page_size):
+            update.stage(data)
+        update.apply()
+    finally:
+        update.close()
+
+async def update_mirror_async(connection, api_base_uri, url, headers, metrics, page_size=None):
+    update = await run_on_cpu(MirrorUpdate, connection, api_base_uri, url)
+    try:
+        async for data in get_item_pages_async(update.url, update.query_params, headers, metrics, page_size):
+            await run_on_cpu(update.stage, data)
+        await run_on_cpu(update.apply)
+    finally:
+        await run_on_cpu(update.close)
+
+class MirrorUpdate:
+
+    # the changes of an update of the mirror staged in a temporary table;
+    # the url and query params are those of the items to request
+    def __init__(self, connection, api_base_uri, url):
+        self.connection = connection
+        self.get_index_rows = get_item_extractor(MIRROR_INDEXES, nested=True)
+        self.update_time = connection.execute('SELECT MAX(update_time) FROM items').fetchone()[0]
+
+        if self.update_time is None:
+            self.url = url
+            self.query_params = {}
+        else:
+            self.url = api_base_uri + '/v1/recents'
+            self.query_params = {'items': RECENTS_ITEM, 'since_timestamp': self.update_time}
+
+        self.columns = 'id, item, update_time' + ''.join(', "' + c + '"' for c in MIRROR_INDEXES)
+        connection.execute('DROP TABLE IF EXISTS temp.staged_items')
+        connection.execute('CREATE TEMP TABLE staged_items (id INTEGER PRIMARY KEY, deleted INTEGER NOT NULL, item BLOB, ' + ', '.join('"' + c + '" TEXT' for c in ['update_time'] + MIRROR_INDEXES) + ')')
+        self.insert = 'INSERT OR REPLACE INTO staged_items (deleted, ' + self.columns + ') VALUES (?, ?, ?' + ', ?' * (len(MIRROR_INDEXES) + 1) + ')'
+
+    def stage(self, data):
+        rows = []
         for item in data:
-            item = get_item_info(item)
-            buffer = buffer + json.dumps(item, default=to_string) + "\n"
-        yield buffer
+            if self.update_time is not None:
+                if item.get('item') != RECENTS_ITEM or item.get('data') is None:
+                    continue
+                item = item.get('data')
+            if is_item_deleted(item):
+                rows.append([1, item.get('id'), None, None] + [None] * len(MIRROR_INDEXES))
+                continue
+            index_values = [to_filter_values(v)[0] for v in self.get_index_rows(item)[0].values()]
+            rows.append([0, item.get('id'), json_dumps(item), item.get('update_time')] + index_values)
+        with self.connection:
+            self.connection.executemany(self.insert, rows)
+
+    def apply(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM items WHERE id IN (SELECT id FROM staged_items WHERE deleted = 1)')
+            self.connection.execute('INSERT OR REPLACE INTO items (' + self.columns + ') SELECT ' + self.columns + ' FROM staged_items WHERE deleted = 0')
+
+    def close(self):
+        self.connection.execute('DROP TABLE IF EXISTS temp.staged_items')
+
+def make_private_dir(path):
+
+    # the mirrors and cached pages hold the items of a connection, so their
+    # directories are only accessible by the user running the function; a
+    # directory at the same path that's owned by another user isn't used
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name != 'posix':
+        return
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid():
+        raise ValueError("The directory '" + path + "' is owned by another user")
+    if stat.st_mode & 0o077 != 0:
+        os.chmod(path, 0o700)
+
+def get_mirror_query(conditions):
+
+    # the indexed properties are stored as the text the filter compares,
+    # so conditions on them are matched with the values given; 1 and 0 are
+    # also matched against the text stored for true and false
+    where = []
+    query_params = []
+    for key, values in conditions.items():
+        if key not in MIRROR_INDEXES:
+            continue
+        values = set(v.lower() for v in values)
+        values.update([{'1': 'true', '0': 'false'}[v] for v in values if v in ('1', '0')])
+        where.append('"' + key + '" IN (' + ', '.join('?' * len(values)) + ')')
+        query_params.extend(sorted(values))
+
+    query = 'SELECT item FROM items'
+    if len(where) > 0:
+        query = query + ' WHERE ' + ' AND '.join(where)
+    return query + ' ORDER BY id', query_params
+
+def get_pages(url, query_params, headers, metrics, page_size=None, concurrency=PAGE_CONCURRENCY):
+
+    # the pipedrive 'start' cursor is a plain offset, so the pages after the
+    # current one are requested ahead of time on a thread pool; pages are
+    # still returned in order and fetching stops at the end of the collection;
+    # the first page is requested on its own since many collections fit in
+    # a single page, and pages are only requested ahead once the api reports
+    # that there are more items
+    if CACHE_TTL > 0:
+        cached_pages = load_cached_pull(url, query_params, headers)
+        if cached_pages is not None:
+            for page in cached_pages:
+                yield page
+                metrics.add_page(page)
+            return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    page_sizer = PageSizer(page_size, get_rate_limiter(headers))
+    pull = CachedPull(url, query_params, headers)
+    pending = deque()
+    page_cursor_id = 0
+    pages_ahead = 1
+    page = None
+    try:
+        while True:
+
+            while len(pending) < pages_ahead:
+                page_size = page_sizer.get_size()
+                cancelled = threading.Event()
+                future = executor.submit(get_page, url, query_params, headers, metrics, page_cursor_id, page_size, pull.generation, cancelled)
+                pending.append((page_cursor_id, page_size, future, cancelled))
+                page_cursor_id = page_cursor_id + page_size
+
+            page_start, page_size, future, cancelled = pending.popleft()
+            start = time.perf_counter()
+            page = future.result()
+            metrics.add_time('wait', time.perf_counter() - start)
+
+            # the item count and pagination of a streamed page are only
+            # known once its items have been read by the caller
+            yield page
+            page.close()
+            page_sizer.update(page)
+            metrics.add_page(page)
+            pull.add_page(page_start, page_size)
+
+            if page.count == 0: # sanity check in case there's an issue with cursor
+                break
+
+            pagination = page.pagination
+            has_more = pagination.get('more_items_in_collection', False)
+            if has_more == False:
+                break
+
+            next_start = pagination.get('next_start')
+            if next_start is None:
+                break
+
+            if next_start != page_start + page_size:
+                # the cursor didn't advance by a full page; discard the pages
+                # requested ahead and continue from the returned cursor
+                cancel_pages(pending)
+                page_cursor_id = next_start
+
+            pages_ahead = concurrency
+
+        pull.save()
+    finally:
+        if page is not None:
+            page.close()
+        cancel_pages(pending)
+        executor.shutdown(wait=False)
+
+def cancel_pages(pending):
+
+    # pages that are already being requested are told to stop before their
+    # request is sent, including while they wait on the rate limiter; the
+    # ones that were sent may hold an open streamed response, which is
+    # closed once the request finishes
+    while len(pending) > 0:
+        page_start, page_size, future, cancelled = pending.popleft()
+        cancelled.set()
+        future.cancel()
+        future.add_done_callback(close_page)
+
+def close_page(future):
+    if future.cancelled() == False and future.exception() is None:
+        future.result().close()
+
+async def get_pages_async(url, query_params, headers, metrics, page_size=None, concurrency=PAGE_CONCURRENCY):
+
+    # same as get_pages with the pages requested ahead as tasks on the event
+    # loop rather than on a thread pool
+    if CACHE_TTL > 0:
+        cached_pages = load_cached_pull(url, query_params, headers)
+        if cached_pages is not None:
+            for page in cached_pages:
+                yield page
+                metrics.add_page(page)
+            return
+
+    page_sizer = PageSizer(page_size, get_rate_limiter(headers))
+    pull = CachedPull(url, query_params, headers)
+    pending = deque()
+    page_cursor_id = 0
+    pages_ahead = 1
+    try:
+        while True:
+
+            while len(pending) < pages_ahead:
+                page_size = page_sizer.get_size()
+                task = asyncio.ensure_future(get_page_async(url, query_params, headers, metrics, page_cursor_id, page_size, pull.generation))
+                pending.append((page_cursor_id, page_size, task))
+                page_cursor_id = page_cursor_id + page_size
+
+            page_start, page_size, task = pending.popleft()
+            start = time.perf_counter()
+            page = await task
+            metrics.add_time('wait', time.perf_counter() - start)
+
+            yield page
+            page_sizer.update(page)
+            metrics.add_page(page)
+            pull.add_page(page_start, page_size)
+
+            if page.count == 0: # sanity check in case there's an issue with cursor
+                break
+
+            pagination = page.pagination
+            has_more = pagination.get('more_items_in_collection', False)
+            if has_more == False:
+                break
+
+            next_start = pagination.get('next_start')
+            if next_start is None:
+                break
+
+            if next_start != page_start + page_size:
+                cancel_tasks(pending)
+                page_cursor_id = next_start
+
+            pages_ahead = concurrency
+
+        pull.save()
+    finally:
+        cancel_tasks(pending)
+
+def cancel_tasks(pending):
+    while len(pending) > 0:
+        page_start, page_size, task = pending.popleft()
+        task.cancel()
+        task.add_done_callback(discard_task)
+
+def discard_task(task):
+    # retrieve the error of a page that's no longer needed so it isn't
+    # reported as unhandled
+    if task.cancelled() == False:
+        task.exception()
+
+class PageSizer:
+
+    # picks the size of the pages to request from the time and number of
+    # bytes per item of the pages requested so far; a given page size is
+    # used as-is
+    def __init__(self, page_size, rate_limiter):
+        self.fixed = page_size is not None
+        self.page_size = page_size if page_size is not None else PAGE_SIZE_MAX
+        self.rate_limiter = rate_limiter
+
+    def get_size(self):
+        return self.page_size
+
+    def update(self, page):
+        if self.fixed or page.elapsed is None or page.count == 0:
+            return
+
+        # the elapsed time of a streamed page only runs until the headers
+        # arrive, and the rest of the response is read while its items are
+        # decoded, so the time of a page includes its decode time
+        page_time = page.elapsed + page.decode_time
+
+        page_size = PAGE_SIZE_MAX
+        page_size = min(page_size, PAGE_TARGET_TIME * page.count / max(page_time, 0.001))
+        page_size = min(page_size, PAGE_TARGET_BYTES * page.count / max(page.content_size, 1))
+
+        # smaller pages take more requests, so pages are only made smaller
+        # when there's room left in the rate limit
+        if self.rate_limiter.get_headroom() < PAGE_MIN_HEADROOM:
+            page_size = max(page_size, self.page_size)
+
+        # move halfway to the new size to even out differences between pages
+        page_size = (self.page_size + page_size) / 2
+        self.page_size = int(max(PAGE_SIZE_MIN, min(PAGE_SIZE_MAX, page_size)))
+
+def get_page(url, query_params, headers, metrics, page_start=None, page_size=None, generation=None, cancelled=None):
+
+    # callers requesting a page that's already being requested wait for its
+    # content and parse their own copy of it; the page is requested again
+    # when the shared request fails
+    page_url = get_page_url(url, query_params, page_start, page_size)
+    flight, is_first = join_flight(page_url, headers)
+    if is_first == False:
+        content = flight.future.result()
+        if content is not None:
+            metrics.add_count('coalesced')
+            return Page(content)
+        flight = None
+
+    try:
+        return fetch_page(page_url, headers, metrics, flight, generation, cancelled)
+    except BaseException:
+        if flight is not None:
+            flight.finish(None)
+        raise
+
+def fetch_page(page_url, headers, metrics, flight=None, generation=None, cancelled=None):
+
+    # pages requested as part of a collection are saved with the generation
+    # of the request of the collection and are only returned as-is from the
+    # cache along with the rest of the collection (see load_cached_pull)
+    stream = STREAM_PAGES and ijson is not None
+
+    if CACHE_TTL <= 0:
+        start = time.monotonic()
+        response = send_request(page_url, headers, metrics, stream, cancelled)
+        elapsed = time.monotonic() - start
+        response.raise_for_status()
+        if stream:
+            return Page(response=response, elapsed=elapsed, flight=flight)
+        return Page(response.content, elapsed=elapsed, content_size=len(response.content), flight=flight)
+
+    cache_path = get_cache_path(page_url, headers)
+    cache_info, cache_content = load_cached_page(cache_path)
+    if generation is None and cache_info is not None and time.time() - cache_info.get('time', 0) < CACHE_TTL:
+        return Page(cache_content, flight=flight)
+
+    # revalidate the page when the api returned validators for it
+    request_headers = dict(headers)
+    if cache_info is not None and cache_info.get('etag') is not None:
+        request_headers['If-None-Match'] = cache_info.get('etag')
+    if cache_info is not None and cache_info.get('last_modified') is not None:
+        request_headers['If-Modified-Since'] = cache_info.get('last_modified')
+
+    start = time.monotonic()
+    response = send_request(page_url, request_headers, metrics, stream, cancelled)
+    elapsed = time.monotonic() - start
+    if response.status_code == 304 and cache_info is not None:
+        response.close()
+        save_cached_page(cache_path, cache_info.get('etag'), cache_info.get('last_modified'), cache_content, generation)
+        return Page(cache_content, flight=flight)
+
+    response.raise_for_status()
+    if stream:
+        return Page(response=response, cache_path=cache_path, cache_generation=generation, elapsed=elapsed, flight=flight)
+    save_cached_page(cache_path, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.content, generation)
+    return Page(response.content, elapsed=elapsed, content_size=len(response.content), flight=flight)
+
+async def get_page_async(url, query_params, headers, metrics, page_start=None, page_size=None, generation=None):
+
+    # same as get_page; the pages requested by both share their requests
+    page_url = get_page_url(url, query_params, page_start, page_size)
+    flight, is_first = join_flight(page_url, headers)
+    if is_first == False:
+        content = await asyncio.shield(asyncio.wrap_future(flight.future))
+        if content is not None:
+            metrics.add_count('coalesced')
+            return await run_on_cpu(Page, content)
+        flight = None
+
+    try:
+        return await fetch_page_async(page_url, headers, metrics, flight, generation)
+    except BaseException:
+        if flight is not None:
+            flight.finish(None)
+        raise
+
+async def fetch_page_async(page_url, headers, metrics, flight=None, generation=None):
+
+    # same as fetch_page except that the page is read in full before it's
+    # parsed on the cpu threads rather than streamed
+
+    if CACHE_TTL <= 0:
+        start = time.monotonic()
+        response = await send_request_async(page_url, headers, metrics)
+        elapsed = time.monotonic() - start
+        response.raise_for_status()
+        return await run_on_cpu(Page, response.content, elapsed=elapsed, content_size=len(response.content), flight=flight)
+
+    cache_path = get_cache_path(page_url, headers)
+    cache_info, cache_content = load_cached_page(cache_path)
+    if generation is None and cache_info is not None and time.time() - cache_info.get('time', 0) < CACHE_TTL:
+        return await run_on_cpu(Page, cache_content, flight=flight)
+
+    request_headers = dict(headers)
+    if cache_info is not None and cache_info.get('etag') is not None:
+        request_headers['If-None-Match'] = cache_info.get('etag')
+    if cache_info is not None and cache_info.get('last_modified') is not None:
+        request_headers['If-Modified-Since'] = cache_info.get('last_modified')
+
+    start = time.monotonic()
+    response = await send_request_async(page_url, request_headers, metrics)
+    elapsed = time.monotonic() - start
+    if response.status_code == 304 and cache_info is not None:
+        save_cached_page(cache_path, cache_info.get('etag'), cache_info.get('last_modified'), cache_content, generation)
+        return await run_on_cpu(Page, cache_content, flight=flight)
+
+    response.raise_for_status()
+    save_cached_page(cache_path, response.headers.get('ETag'), response.headers.get('Last-Modified'), response.content, generation)
+    return await run_on_cpu(Page, response.content, elapsed=elapsed, content_size=len(response.content), flight=flight)
+
+def get_page_url(url, query_params, page_start=None, page_size=None):
+    url_query_params = OrderedDict()
+    if page_size is not None:
+        url_query_params['limit'] = page_size
+        url_query_params['start'] = page_start
+    url_query_params.update(query_params)
+    if len(url_query_params) == 0:
+        return url
+    url_query_str = urllib.parse.urlencode(url_query_params)
+    return url + '?' + url_query_str
+
+flights_lock = threading.Lock()
+flights = {}
+
+def join_flight(page_url, headers):
+
+    # return the flight for a page along with whether the caller is the
+    # first to request it and should make the request
+    if COALESCE_PAGES == False:
+        return None, True
+    key = page_url + '|' + headers.get('Authorization', '')
+    with flights_lock:
+        if key in flights:
+            return flights[key], False
+        flights[key] = Flight(key)
+        return flights[key], True
+
+class Flight:
+
+    # a page request shared by the callers requesting the same page at the
+    # same time; the callers waiting on it are passed the content of the page
+    # once the first caller has read all of it, or None when that fails
+    def __init__(self, key):
+        self.key = key
+        self.future = Future()
+
+    def finish(self, content):
+        with flights_lock:
+            if flights.get(self.key) is self:
+                del flights[self.key]
+            if self.future.done() == False:
+                self.future.set_result(content)
+
+class Page:
+
+    # the items and pagination of a page along with the time taken by the
+    # request and the size of the content, which aren't set for pages from
+    # the cache; the items of a streamed page are parsed as they're read
+    # from the response, so the item count, pagination, content size and
+    # time spent reading and parsing are only set once all of them have been
+    # read, and the page is saved to the cache at that point when a cache
+    # path is given; the content is passed on to the flight for the page,
+    # when there is one, at the same point
+    def __init__(self, content=None, response=None, cache_path=None, cache_generation=None, elapsed=None, content_size=0, flight=None):
+        self.response = response
+        self.cache_path = cache_path
+        self.cache_generation = cache_generation
+        self.elapsed = elapsed
+        self.content_size = content_size
+        self.decode_time = 0
+        self.flight = flight
+        if response is None:
+            if flight is not None:
+                flight.finish(content)
+            start = time.perf_counter()
+            content = json_loads(content)
+            self.decode_time = time.perf_counter() - start
+            self.items = content.get('data') or []
+            self.count = len(self.items)
+            self.pagination = (content.get('additional_data') or {}).get('pagination') or {}
+        else:
+            self.items = self.get_streamed_items()
+            self.count = 0
+            self.pagination = {}
+
+    def get_streamed_items(self):
+        reader = ResponseReader(self.response, self.cache_path is not None or self.flight is not None)
+        try:
+            builder = None
+            builder_prefix = None
+            start = time.perf_counter()
+            for prefix, event, value in ijson.parse(reader, use_float=True):
+                if builder is None:
+                    if event != 'start_map' or prefix not in ('data.item', 'additional_data.pagination'):
+                        continue
+                    builder = ijson.ObjectBuilder()
+                    builder_prefix = prefix
+                builder.event(event, value)
+                if event != 'end_map' or prefix != builder_prefix:
+                    continue
+                if builder_prefix == 'data.item':
+                    self.count = self.count + 1
+                    self.decode_time = self.decode_time + time.perf_counter() - start
+                    yield builder.value
+                    start = time.perf_counter()
+                else:
+                    self.pagination = builder.value
+                builder = None
+            self.decode_time = self.decode_time + time.perf_counter() - start
+            self.content_size = reader.size
+            if self.cache_path is not None:
+                headers = self.response.headers
+                save_cached_page(self.cache_path, headers.get('ETag'), headers.get('Last-Modified'), bytes(reader.buffer), self.cache_generation)
+            if self.flight is not None:
+                self.flight.finish(bytes(reader.buffer))
+        finally:
+            self.close()
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        if self.flight is not None:
+            self.flight.finish(None)
+
+class ResponseReader:
+
+    # file-like object over the decompressed content of a streamed response;
+    # each read returns the next chunk and the content read so far is kept
+    # when it's needed for the cache
+    def __init__(self, response, keep_content):
+        self.chunks = response.iter_content(chunk_size=PAGE_CHUNK_SIZE)
+        self.buffer = bytearray() if keep_content else None
+        self.size = 0
+
+    def read(self, size=-1):
+        if size == 0:
+            return b''
+        data = next(self.chunks, b'')
+        self.size = self.size + len(data)
+        if self.buffer is not None:
+            self.buffer += data
+        return data
+
+cache_lock = threading.Lock()
+cache_size = None
+
+def get_cache_path(page_url, headers):
 
-        has_more = content.get('additional_data',{}).get('pagination',{}).get('more_items_in_collection', False)
-        if has_more == False:
+    # pages are cached per access token so that cached pages are only ever
+    # returned to callers that are able to request the same page
+    key = page_url + '|' + headers.get('Authorization', '')
+    return os.path.join(CACHE_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+def load_cached_page(path):
+
+    # cached pages are stored as a line of json with the page info followed
+    # by the compressed page content
+    try:
+        with open(path, 'rb') as f:
+            cache_info = json.loads(f.readline().decode('utf-8'))
+            cache_content = zlib.decompress(f.read())
+        os.utime(path) # mark the page as recently used
+    except (IOError, ValueError, zlib.error):
+        return None, None
+    return cache_info, cache_content
+
+def save_cached_page(path, etag, last_modified, content, generation=None):
+
+    global cache_size
+
+    cache_info = {'time': time.time(), 'etag': etag, 'last_modified': last_modified, 'generation': generation}
+    data = json.dumps(cache_info).encode('utf-8') + b"\n" + zlib.compress(content)
+    save_cached_file(path, data)
+
+    with cache_lock:
+        if cache_size is None:
+            cache_size = get_cache_size()
+        cache_size = cache_size + len(data)
+        if cache_size > CACHE_MAX_SIZE:
+            cache_size = evict_cached_pages(CACHE_MAX_SIZE // 2)
+
+def save_cached_file(path, data):
+    make_private_dir(CACHE_DIR)
+    with tempfile.NamedTemporaryFile('wb', dir=CACHE_DIR, prefix='.', delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+class CachedPull:
+
+    # the pages of a request of a whole collection, which are saved with the
+    # same generation; once all the pages have been requested, the list of
+    # them is saved so the collection can be returned from the cache
+    def __init__(self, url, query_params, headers):
+        self.url = url
+        self.query_params = query_params
+        self.headers = headers
+        self.generation = os.urandom(16).hex() if CACHE_TTL > 0 else None
+        self.time = time.time()
+        self.pages = []
+
+    def add_page(self, page_start, page_size):
+        if self.generation is not None:
+            self.pages.append(get_cache_path(get_page_url(self.url, self.query_params, page_start, page_size), self.headers))
+
+    def save(self):
+        if self.generation is None:
+            return
+        pull_info = {'time': self.time, 'generation': self.generation, 'pages': [os.path.basename(p) for p in self.pages]}
+        save_cached_file(get_pull_path(self.url, self.query_params, self.headers), json.dumps(pull_info).encode('utf-8'))
+
+def get_pull_path(url, query_params, headers):
+    return get_cache_path(get_page_url(url, query_params) + '#pull', headers)
+
+def load_cached_pull(url, query_params, headers):
+
+    # return the pages of a collection from the cache when the last request
+    # of all of it started within the ttl and all of its pages are still
+    # cached with its generation; the page files are opened up front so the
+    # pages can't be evicted or replaced while they're read
+    try:
+        with open(get_pull_path(url, query_params, headers), 'rb') as f:
+            pull_info = json.loads(f.read().decode('utf-8'))
+    except (IOError, ValueError):
+        return None
+    if time.time() - pull_info.get('time', 0) >= CACHE_TTL:
+        return None
+
+    files = []
+    try:
+        for name in pull_info.get('pages') or []:
+            path = os.path.join(CACHE_DIR, name)
+            files.append(open(path, 'rb'))
+            cache_info = json.loads(files[-1].readline().decode('utf-8'))
+            if cache_info.get('generation') != pull_info.get('generation'):
+                raise ValueError("The page is from another request")
+            os.utime(path) # mark the page as recently used
+    except (IOError, ValueError):
+        for f in files:
+            f.close()
+        return None
+    return read_cached_pull(files)
+
+def read_cached_pull(files):
+    try:
+        for f in files:
+            yield Page(zlib.decompress(f.read()))
+    finally:
+        for f in files:
+            f.close()
+
+def get_cache_size():
+    return sum(size for path, mtime, size in get_cached_pages())
+
+def evict_cached_pages(max_size):
+
+    # remove the least recently used pages until the cache is under the
+    # given size and return the resulting size
+    pages = sorted(get_cached_pages(), key=lambda page: page[1], reverse=True)
+    total_size = 0
+    for path, mtime, size in pages:
+        if total_size + size <= max_size:
+            total_size = total_size + size
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return total_size
+
+def get_cached_pages():
+    pages = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith('.'):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        pages.append((entry.path, stat.st_mtime, stat.st_size))
+    return pages
+
+def send_request(url, headers, metrics, stream=False, cancelled=None):
+
+    # all requests for a connection share a rate limiter; requests that are
+    # rate limited anyway are retried after the delay given by the api; a
+    # request that's no longer needed by the time it may be sent isn't sent
+    rate_limiter = get_rate_limiter(headers)
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        rate_limiter.acquire(cancelled)
+        if cancelled is not None and cancelled.is_set():
+            raise CancelledError()
+        start = time.perf_counter()
+        response = get_session().get(url, headers=headers, stream=stream, timeout=(REQUEST_CONNECT_TIMEOUT, REQUEST_READ_TIMEOUT))
+        metrics.add_request(response, time.perf_counter() - start, attempt)
+        rate_limiter.update(response)
+        if response.status_code != 429:
             break
+        response.close()
+    return response
+
+async def send_request_async(url, headers, metrics, retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)):
 
-        page_cursor_id = content.get('additional_data',{}).get('pagination',{}).get('next_start')
-        if page_cursor_id is None:
+    # same as send_request; the httpx transport only retries failed
+    # connections, so server errors are retried here with the same backoff
+    # as the session used by send_request
+    rate_limiter = get_rate_limiter(headers)
+    client = get_async_client()
+    errors = 0
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        await rate_limiter.acquire_async()
+        start = time.perf_counter()
+        response = await client.get(url, headers=headers)
+        metrics.add_request(response, time.perf_counter() - start, attempt)
+        rate_limiter.update(response)
+        if response.status_code in status_forcelist and errors < retries:
+            await asyncio.sleep(backoff_factor * (2 ** errors))
+            errors = errors + 1
+            continue
+        if response.status_code != 429:
             break
+    return response
+
+async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+
+    # an httpx client is bound to the event loop it's used on, so a client
+    # and its pooled connections are shared by the calls on each loop
+    loop = asyncio.get_running_loop()
+    if loop not in async_clients:
+        limits = httpx.Limits(max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=ASYNC_POOL_SIZE if KEEP_ALIVE else 0)
+        transport = httpx.AsyncHTTPTransport(retries=3, limits=limits)
+        timeout = httpx.Timeout(REQUEST_READ_TIMEOUT, connect=REQUEST_CONNECT_TIMEOUT)
+        async_clients[loop] = httpx.AsyncClient(transport=transport, timeout=timeout, headers={'Accept-Encoding': ACCEPT_ENCODING})
+    return async_clients[loop]
+
+async def close_async_client():
+    client = async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+cpu_executor_lock = threading.Lock()
+cpu_executor = None
+
+def get_cpu_executor():
+    global cpu_executor
+    with cpu_executor_lock:
+        if cpu_executor is None:
+            cpu_executor = ThreadPoolExecutor(max_workers=ASYNC_CPU_WORKERS, thread_name_prefix='pipedrive-cpu')
+        return cpu_executor
+
+async def run_on_cpu(fn, *args, **kwargs):
+
+    # runs the cpu work of get_data_async on the threads shared by all of the
+    # calls; a caller that's cancelled waits for its work to finish first so
+    # the encoder or mirror connection it uses isn't closed while in use
+    future = asyncio.get_running_loop().run_in_executor(get_cpu_executor(), functools.partial(fn, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(discard_task)
+        await asyncio.wait([future])
+        raise
+
+rate_limiters_lock = threading.Lock()
+rate_limiters = {}
+
+def get_rate_limiter(headers):
+
+    # the api rate limit applies per access token
+    key = headers.get('Authorization', '')
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(RATE_LIMIT_WINDOW)
+        return rate_limiters[key]
+
+class RateLimiter:
+
+    # token bucket that's sized from the X-RateLimit-* headers returned by
+    # the api; until the first response, requests aren't paced
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.window = window
+        self.capacity = None
+        self.tokens = None
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def acquire(self, cancelled=None):
+        # stop waiting once the request is cancelled
+        wait = self.reserve()
+        while wait > 0:
+            if cancelled is None:
+                time.sleep(wait)
+            elif cancelled.wait(wait):
+                return
+            wait = self.reserve()
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.reserve()
+
+    def reserve(self):
+        # take a token when one is available and otherwise return the time
+        # to wait before trying again
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            if wait > 0:
+                return wait
+            if self.capacity is None:
+                return 0
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                return 0
+            return (1 - self.tokens) * self.window / self.capacity
+
+    def update(self, response):
+        limit = to_number(response.headers.get('X-RateLimit-Limit'))
+        remaining = to_number(response.headers.get('X-RateLimit-Remaining'))
+        reset = to_number(response.headers.get('X-RateLimit-Reset'))
+        retry_after = to_number(response.headers.get('Retry-After'))
+
+        with self.lock:
+            now = time.monotonic()
+            if limit is not None and limit > 0:
+                if self.capacity is None:
+                    self.tokens = limit
+                self.capacity = limit
+                self.refill(now)
+            if remaining is not None and self.tokens is not None:
+                self.tokens = min(self.tokens, remaining)
+
+            # wait for the window to reset when there aren't any requests left
+            # and honor the exact delay the api asks for when rate limited
+            delay = 0
+            if remaining is not None and remaining <= 0 and reset is not None:
+                delay = reset
+            if response.status_code == 429:
+                delay = retry_after if retry_after is not None else (reset if reset is not None else 1)
+            self.blocked_until = max(self.blocked_until, now + delay)
+
+    def get_headroom(self):
+        # fraction of the rate limit that's left; no limit is known until
+        # the first response
+        with self.lock:
+            if self.capacity is None:
+                return 1
+            self.refill(time.monotonic())
+            return self.tokens / self.capacity
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.window)
+        self.updated = now
+
+class Metrics:
+
+    # the time spent in each stage of a call and counts of the requests,
+    # pages, rows and bytes; request time is the total across the page
+    # threads while wait is the time spent waiting for pages to arrive
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.times = OrderedDict((stage, 0.0) for stage in ('request', 'wait', 'decode', 'map', 'encode', 'write'))
+        self.counts = OrderedDict((name, 0) for name in ('requests', 'retries', 'rate_limited', 'coalesced', 'pages', 'rows', 'bytes_in', 'bytes_out'))
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.times[stage] = self.times[stage] + seconds
+
+    def add_count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts[name] + value
+
+    def add_request(self, response, seconds, attempt):
+        # include the retries made by the session, which may also have been
+        # rate limited; httpx responses don't have a retry history
+        retries = getattr(getattr(getattr(response, 'raw', None), 'retries', None), 'history', None) or ()
+        statuses = [r.status for r in retries] + [response.status_code]
+        with self.lock:
+            self.times['request'] = self.times['request'] + seconds
+            self.counts['requests'] = self.counts['requests'] + 1
+            self.counts['retries'] = self.counts['retries'] + len(retries) + (1 if attempt > 0 else 0)
+            self.counts['rate_limited'] = self.counts['rate_limited'] + statuses.count(429)
+
+    def add_page(self, page):
+        with self.lock:
+            self.times['decode'] = self.times['decode'] + page.decode_time
+            self.counts['pages'] = self.counts['pages'] + 1
+            self.counts['bytes_in'] = self.counts['bytes_in'] + page.content_size
+
+    def get_summary(self):
+        with self.lock:
+            summary = OrderedDict()
+            summary['seconds'] = time.monotonic() - self.start
+            summary.update((stage + '_seconds', seconds) for stage, seconds in self.times.items())
+            summary.update(self.counts)
+            return summary
+
+# the summaries are logged at the info level, so they're written to stderr
+# unless logging has been set up by the process running the function
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+if len(logging.getLogger().handlers) == 0:
+    logger.addHandler(logging.StreamHandler())
+    logger.propagate = False
+
+def report_metrics(api_base_uri, metrics):
+
+    summary = OrderedDict()
+    summary['function'] = ITEM_PATH
+    summary['api_base_uri'] = api_base_uri
+    summary.update(metrics.get_summary())
+
+    if METRICS_LOG:
+        logger.info(json_dumps(summary).decode('utf-8'))
+
+    if METRICS_DIR is None:
+        return
+
+    # the metrics of the last call are written to a file per function and
+    # company domain; the values are gauges labeled with both
+    labels = 'function="' + ITEM_PATH + '",api_base_uri="' + str(api_base_uri) + '"'
+    lines = []
+    for name, value in list(summary.items())[2:]:
+        lines.append('# TYPE pipedrive_' + name + ' gauge')
+        lines.append('pipedrive_' + name + '{' + labels + '} ' + repr(value))
+
+    # write to a temporary file first so that the collector never reads a
+    # partially written file; the temporary file name doesn't end in .prom
+    key = ITEM_PATH + '|' + str(api_base_uri)
+    path = os.path.join(METRICS_DIR, 'pipedrive-' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:16] + '.prom')
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=METRICS_DIR, delete=False) as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(f.name, path)
+
+def to_number(value):
+
+    # header values are either a number of seconds or, for Retry-After, an
+    # http date
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+session_shared = None
+
+def get_session():
+
+    # reuse the same session (and its pooled keep-alive connections) for
+    # every page and across warm invocations of the function
+    global session_shared
+    if session_shared is None:
+        session_shared = requests_retry_session(pool_size=get_pool_size(), keep_alive=KEEP_ALIVE)
+        session_shared.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session_shared
+
+def get_pool_size():
+
+    # the pages of the items and of each join are requested ahead at the
+    # same time and a streamed page holds its connection until it's read,
+    # so the pool is sized for all of these to be kept alive
+    return max(POOL_SIZE, PAGE_CONCURRENCY * (1 + len(JOINS)), LOOKUP_CONCURRENCY)
 
 def requests_retry_session(
     retries=3,
     backoff_factor=0.3,
-    status_forcelist=(500, 502, 504),
+    status_forcelist=(500, 502, 503, 504),
+    pool_size=10,
+    keep_alive=True,
     session=None,
 ):
     session = session or requests.Session()
@@ -208,14 +2292,211 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
+    if keep_alive == False:
+        session.headers['Connection'] = 'close'
     return session
 
-def to_date(value):
-    # TODO: convert if needed
-    return value
+def get_properties(params):
+
+    # properties may be passed as an array or as a comma-delimited string;
+    # when no properties are specified, all properties other than the ones
+    # from related items are returned; a property that's repeated is only
+    # returned the first time, since each row has a single value for each
+    # property
+    properties = params.get('properties') or []
+    if isinstance(properties, str):
+        properties = [properties]
+    properties = [p.strip().lower() for i in properties for p in str(i).split(',')]
+    properties = list(OrderedDict.fromkeys(p for p in properties if len(p) > 0))
+
+    if len(properties) == 0 or properties == ['*']:
+        return [p for p in PROPERTIES.keys() if is_default_property(p)]
+
+    for p in properties:
+        if p not in PROPERTIES:
+            raise ValueError("Invalid property: '" + p + "'")
+    return properties
+
+def is_default_property(p):
+    return PROPERTIES[p][0].split('.')[0] not in JOINS
+
+def get_item_extractor(properties, conditions=None, joined_items=None, nested=False):
+
+    # compile the mapping for the requested properties and the conditions
+    # on them into a function that returns the rows for an item as dicts
+    # with the properties in order; nested objects used by more than one
+    # property are only looked up once
+    #
+    # a property maps to a path of keys separated by '.' and a type,
+    # optionally followed by a default value; 'key[primary]' selects the
+    # primary entry of a list of values (e.g. emails) and a path that starts
+    # with the name of the item's details refers to the detail the row is
+    # returned for; a path that starts with the name of a join refers to the
+    # related item, which is looked up in the joined items by its id
+    #
+    # when a row is returned for each of an item's details, the item's own
+    # properties are looked up and checked once for all of its details; in
+    # the nested layout, a single row is returned with the details that
+    # match the conditions in a list and items without any are skipped when
+    # there are conditions on the details
+    conditions = conditions or {}
+    names = {}
+    lines = {False: [], True: []}
+
+    def is_detail(path):
+        return ITEM_DETAILS is not None and path[0] == ITEM_DETAILS
+
+    def get_variable(path):
+        if len(path) == 0:
+            return 'item'
+        if path == (ITEM_DETAILS,):
+            return 'detail'
+        if path not in names:
+            parent, key = get_variable(path[:-1]), path[-1]
+            if len(path) == 1 and key in JOINS:
+                key_path = tuple(JOINS[key][0].split('.'))
+                key_value = get_variable(key_path[:-1]) + '.get(' + repr(key_path[-1]) + ')'
+                lookup = '(joined_items[' + repr(key) + '].get(' + key_value + ') or {})'
+            elif key.endswith('[primary]'):
+                lookup = 'get_primary_item(' + parent + '.get(' + repr(key[:-len('[primary]')]) + '))'
+            else:
+                lookup = '(' + parent + '.get(' + repr(key) + ') or {})'
+            names[path] = 'v' + str(len(names))
+            lines[is_detail(path)].append(names[path] + ' = ' + lookup)
+        return names[path]
+
+    def get_path(p):
+        return tuple(PROPERTIES[p][0].split('.'))
+
+    values = OrderedDict()
+    for p in list(properties) + [p for p in conditions.keys() if p in PROPERTIES]:
+        if p not in values:
+            path, property_type, default = (PROPERTIES[p] + (None,))[:3]
+            path = tuple(path.split('.'))
+            values[p] = 'p' + str(len(values))
+            lines[is_detail(path)].append(values[p] + ' = ' + get_variable(path[:-1]) + '.get(' + repr(path[-1]) + ', ' + repr(default) + ')')
+
+    # the conditions are checked as soon as the values they're on are known;
+    # values are compared using their text representation
+    namespace = {'get_primary_item': get_primary_item, 'to_filter_values': to_filter_values, 'joined_items': joined_items or {}}
+    for p, condition_values in conditions.items():
+        if p in PROPERTIES:
+            test = 't' + str(len(namespace))
+            namespace[test] = set(v.lower() for v in condition_values)
+            detail = is_detail(get_path(p))
+            lines[detail].append('if ' + test + '.isdisjoint(to_filter_values(' + values[p] + ')):')
+            lines[detail].append('    ' + ('continue' if detail else 'return ()'))
+
+    def get_row(entries, indent):
+        return '{\n' + ''.join(indent + '    ' + repr(key) + ': ' + value + ',\n' for key, value in entries) + indent + '}'
+
+    source = 'def get_item_rows(item):\n'
+    source = source + ''.join('    ' + line + '\n' for line in lines[False])
+    if ITEM_DETAILS is None:
+        source = source + '    return (' + get_row([(p, values[p]) for p in properties], '    ') + ',)\n'
+    elif nested:
+        # the list of details takes the place of the first detail property
+        entries = []
+        detail_entries = []
+        for p in properties:
+            if is_detail(get_path(p)) == False:
+                entries.append((p, values[p]))
+                continue
+            if len(detail_entries) == 0:
+                entries.append((ITEM_DETAILS, 'details'))
+            detail_entries.append((p, values[p]))
+        if len(lines[True]) > 0:
+            source = source + '    details = []\n'
+            source = source + '    for detail in item.get(' + repr(ITEM_DETAILS) + ') or []:\n'
+            source = source + ''.join('        ' + line + '\n' for line in lines[True])
+            source = source + '        details.append(' + get_row(detail_entries, '        ') + ')\n'
+        if any(is_detail(get_path(p)) for p in conditions.keys() if p in PROPERTIES):
+            source = source + '    if len(details) == 0:\n'
+            source = source + '        return ()\n'
+        source = source + '    return (' + get_row(entries, '    ') + ',)\n'
+    else:
+        # if there aren't any details, make sure to return the item info
+        source = source + '    rows = []\n'
+        source = source + '    for detail in item.get(' + repr(ITEM_DETAILS) + ') or [{}]:\n'
+        source = source + ''.join('        ' + line + '\n' for line in lines[True])
+        source = source + '        rows.append(' + get_row([(p, values[p]) for p in properties], '        ') + ')\n'
+        source = source + '    return rows\n'
+
+    exec(compile(source, '<' + ITEM_PATH + ' properties>', 'exec'), namespace)
+    return namespace['get_item_rows']
+
+def get_primary_item(items):
+
+    # get the primary entry from a list of values like phone numbers or emails
+    for i in items or []:
+        if i.get('primary', False) == True:
+            return i
+    return {}
+
+def get_filter(params):
+
+    # the filter is a url query string of property=value pairs; values for
+    # the same property are or'd together and different properties and'ed
+    filter_str = (params.get('filter') or '').strip().lstrip('?')
+    conditions = OrderedDict()
+    for key, value in urllib.parse.parse_qsl(filter_str, keep_blank_values=True):
+        key = key.strip().lower()
+        if key not in PROPERTIES and key not in FILTER_PARAMS:
+            raise ValueError("Invalid filter property: '" + key + "'")
+        conditions.setdefault(key, []).append(value.strip())
+    return conditions
+
+def get_filter_query_params(conditions):
+
+    # push the conditions the api supports down to the api query so that
+    # fewer items are returned; conditions on properties are still checked
+    # against each item since some api params match more loosely
+    query_params = {}
+    for key, values in conditions.items():
+        if key not in FILTER_PARAMS:
+            continue
+        if len(values) > 1:
+            if key in PROPERTIES:
+                continue
+            raise ValueError("Only one value may be specified for the filter property: '" + key + "'")
+        value = values[0]
+        if value.lower() in ('true', 'false'):
+            value = 1 if value.lower() == 'true' else 0
+        query_params[FILTER_PARAMS[key]] = value
+    return query_params
+
+def to_filter_values(value):
+    if value is None:
+        return ('',)
+    if value is True:
+        return ('true', '1')
+    if value is False:
+        return ('false', '0')
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return (str(value).lower(),)
+
+def json_loads(content):
+
+    # decode json directly from the bytes of a response
+    if orjson is not None:
+        return orjson.loads(content)
+    if ujson is not None:
+        return ujson.loads(content)
+    return json.loads(content)
+
+def json_dumps(value):
+
+    # encode a value as utf-8 json bytes; to_string is only called for
+    # values that aren't natively supported, not for every value
+    if orjson is not None:
+        return orjson.dumps(value, default=to_string)
+    if ujson is not None:
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False, default=to_string).encode('utf-8')
+    return json.dumps(value, default=to_string).encode('utf-8')
 
 def to_string(value):
     if isinstance(value, (date, datetime)):
@@ -225,47 +2506,3 @@ def to_string(value):
     if isinstance(value, (Decimal)):
         return str(value)
     return value
-
-def get_item_info(item):
-
-    # map this function's property names to the API's property names
-    info = OrderedDict()
-
-    info['id'] = item.get('id')
-    info['user_id'] = item.get('user_id')
-    info['created_by_user_id'] = item.get('created_by_user_id')
-    info['org_id'] = item.get('org_id')
-    info['org_name'] = item.get('org_name')
-    info['person_id'] = item.get('person_id')
-    info['person_name'] = item.get('person_name')
-    info['lead_id'] = item.get('lead_id')
-    info['lead_title'] = item.get('lead_title')
-    info['deal_id'] = item.get('deal_id')
-    info['deal_title'] = item.get('deal_title')
-    info['subject'] = item.get('subject')
-    info['type'] = item.get('type')
-    info['done'] = item.get('done')
-    info['marked_as_done_time'] = to_date(item.get('marked_as_done_time'))
-    info['due_date'] = to_date(item.get('due_date'))
-    info['due_time'] = to_date(item.get('due_time'))
-    info['duration'] = to_date(item.get('duration'))
-    info['add_time'] = to_date(item.get('add_time'))
-    info['update_time'] = to_date(item.get('update_time'))
-    info['last_notification_time'] = to_date(item.get('last_notification_time'))
-    info['busy_flag'] = item.get('busy_flag')
-    info['public_description'] = item.get('public_description')
-    info['note'] = item.get('note')
-    info['location_subpremise'] = item.get('location_subpremise')
-    info['location_street_number'] = item.get('location_street_number')
-    info['location_route'] = item.get('location_route')
-    info['location_sublocality'] = item.get('location_sublocality')
-    info['location_locality'] = item.get('location_locality')
-    info['location_admin_area_level_1'] = item.get('location_admin_area_level_1')
-    info['location_admin_area_level_2'] = item.get('location_admin_area_level_2')
-    info['location_country'] = item.get('location_country')
-    info['location_postal_code'] = item.get('location_postal_code')
-    info['location_formatted_address'] = item.get('location_formatted_address')
-    info['conference_meeting_client'] = item.get('conference_meeting_client')
-    info['conference_meeting_url'] = item.get('conference_meeting_url')
-
-    return info
\ No newline at end of file
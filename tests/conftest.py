@@ -0,0 +1,84 @@
+# fixtures shared by the tests; the functions are run against the mock
+# server used by the benchmarks, and each test loads its own copy of a
+# function so that settings and state don't carry over between tests
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+from mock_server import start_server
+
+FUNCTIONS = ['deals', 'people', 'organizations', 'activity', 'products']
+ITEM_COUNT = 10
+
+class FlexOutput:
+
+    def __init__(self):
+        self.content_type = None
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+class Flex:
+
+    def __init__(self, params):
+        self.vars = params
+        self.output = FlexOutput()
+
+@pytest.fixture(scope='session')
+def server():
+
+    # a server that's shared by the tests that don't change its items
+    server = start_server(count=ITEM_COUNT)
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def make_server():
+
+    # servers for the tests that change items or need latency
+    servers = []
+
+    def make(**kwargs):
+        server = start_server(**dict({'count': ITEM_COUNT}, **kwargs))
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+
+@pytest.fixture
+def load_function(tmp_path):
+
+    # the mirrors and cached pages are kept in the test's own directory
+    def load(name):
+        path = os.path.join(ROOT_DIR, 'pipedrive-' + name + '.py')
+        spec = importlib.util.spec_from_file_location('pipedrive_' + name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.METRICS_LOG = False
+        module.MIRROR_DIR = str(tmp_path / 'mirrors')
+        module.CACHE_DIR = str(tmp_path / 'pages')
+        return module
+
+    return load
+
+@pytest.fixture
+def run():
+
+    # call a function the way flex.io does and return its output, which
+    # has the content type and the data written
+    def run(module, server, params=None, metrics=None):
+        connection = {'access_token': 'test', 'api_base_uri': server.url}
+        flex = Flex(dict(params or {}, pipedrive_connection=connection))
+        module.flexio_handler(flex, metrics)
+        return flex.output
+
+    return run
@@ -0,0 +1,154 @@
+# the batch runner, which runs the functions for many connections at once
+# against the mock server
+
+import os
+import sys
+import json
+import socket
+import threading
+
+import pytest
+
+from conftest import FUNCTIONS, ROOT_DIR
+
+sys.path.insert(0, os.path.join(ROOT_DIR, 'batch'))
+
+import batch
+
+@pytest.fixture
+def load_functions(tmp_path, monkeypatch):
+
+    # the functions loaded by the runner keep their mirrors and cached
+    # pages in the test's own directory; the modules loaded are kept
+    loaded = []
+    load = batch.load_functions
+
+    def load_functions(names):
+        modules = load(names)
+        for module in modules.values():
+            module.METRICS_LOG = False
+            module.MIRROR_DIR = str(tmp_path / 'mirrors')
+            module.CACHE_DIR = str(tmp_path / 'pages')
+        loaded.append(modules)
+        return modules
+
+    monkeypatch.setattr(batch, 'load_functions', load_functions)
+    return loaded
+
+def get_connection(name, server):
+    return {'name': name, 'access_token': 'token-' + name, 'api_base_uri': server.url}
+
+def get_unreachable_uri():
+
+    # a port nothing listens on, so connections to it are refused
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:' + str(port)
+
+def test_batch_writes_output_per_connection(server, load_functions, tmp_path):
+    connections = [get_connection('a', server), get_connection('b', server)]
+    results = batch.run_batch(connections, FUNCTIONS, {'format': 'csv'}, str(tmp_path / 'out'))
+
+    assert len(results) == len(connections) * len(FUNCTIONS)
+    assert all(r['error'] is None for r in results)
+    for connection in ['a', 'b']:
+        for name in FUNCTIONS:
+            path = tmp_path / 'out' / connection / (name + '.csv')
+            assert path.exists() and path.stat().st_size > 0
+
+def test_batch_caps_running_calls(make_server, load_functions, tmp_path, monkeypatch):
+
+    # no more than the given number of calls run at once overall and for
+    # each connection, and the workers are kept busy up to those caps
+    server = make_server(latency=0.05)
+    lock = threading.Lock()
+    running = {}
+    peaks = {}
+    run_job = batch.run_job
+
+    def count_job(name, module, connection, params, output_dir):
+        with lock:
+            for key in (None, connection['name']):
+                running[key] = running.get(key, 0) + 1
+                peaks[key] = max(peaks.get(key, 0), running[key])
+        try:
+            return run_job(name, module, connection, params, output_dir)
+        finally:
+            with lock:
+                for key in (None, connection['name']):
+                    running[key] = running[key] - 1
+
+    monkeypatch.setattr(batch, 'run_job', count_job)
+    connections = [get_connection(str(i), server) for i in range(3)]
+    results = batch.run_batch(connections, FUNCTIONS, {}, str(tmp_path / 'out'), concurrency=4, connection_concurrency=2)
+
+    assert all(r['error'] is None for r in results)
+    assert peaks[None] == 4
+    assert all(peaks[c['name']] <= 2 for c in connections)
+    assert max(peaks[c['name']] for c in connections) == 2
+
+def test_batch_functions_share_rate_limiters(server, load_functions, tmp_path):
+
+    # the rate limit applies per access token across all of the endpoints,
+    # so each connection has a single rate limiter shared by the functions
+    connections = [get_connection('a', server), get_connection('b', server)]
+    batch.run_batch(connections, ['deals', 'people'], {}, str(tmp_path / 'out'))
+
+    modules = load_functions[0]
+    assert modules['deals'].rate_limiters is modules['people'].rate_limiters
+    for connection in connections:
+        headers = {'Authorization': 'Bearer ' + connection['access_token']}
+        assert modules['deals'].get_rate_limiter(headers) is modules['people'].get_rate_limiter(headers)
+    assert len(modules['deals'].rate_limiters) == len(connections)
+
+def test_batch_keeps_previous_output_on_failure(server, load_functions, tmp_path):
+    output_dir = str(tmp_path / 'out')
+    batch.run_batch([get_connection('a', server)], ['deals'], {}, output_dir)
+    path = tmp_path / 'out' / 'a' / 'deals.ndjson'
+    previous = path.read_bytes()
+
+    connection = dict(get_connection('a', server), api_base_uri=get_unreachable_uri())
+    results = batch.run_batch([connection], ['deals'], {}, output_dir)
+    assert results[0]['error'] is not None
+    assert path.read_bytes() == previous
+    assert os.listdir(str(tmp_path / 'out' / 'a')) == ['deals.ndjson']
+
+def test_batch_unreachable_connection(server, load_functions, tmp_path):
+
+    # a connection that fails doesn't stop the calls for the others
+    bad = dict(get_connection('bad', server), api_base_uri=get_unreachable_uri())
+    connections = [bad, get_connection('good', server)]
+    results = batch.run_batch(connections, ['deals', 'people'], {}, str(tmp_path / 'out'), concurrency=4)
+
+    errors = dict(((r['connection'], r['function']), r['error']) for r in results)
+    assert len(errors) == 4
+    assert errors[('bad', 'deals')] is not None and errors[('bad', 'people')] is not None
+    assert errors[('good', 'deals')] is None and errors[('good', 'people')] is None
+    assert (tmp_path / 'out' / 'good' / 'deals.ndjson').stat().st_size > 0
+    assert (tmp_path / 'out' / 'good' / 'people.ndjson').stat().st_size > 0
+    assert not (tmp_path / 'out' / 'bad' / 'deals.ndjson').exists()
+
+def test_batch_exit_status(server, load_functions, tmp_path, monkeypatch, capsys):
+
+    # the runner exits with a non-zero status when any call fails, after
+    # writing the output of the calls that succeeded and the results
+    bad = dict(get_connection('bad', server), api_base_uri=get_unreachable_uri())
+    jobs = {'connections': [get_connection('good', server), bad], 'functions': ['deals']}
+    jobs_path = tmp_path / 'jobs.json'
+    jobs_path.write_text(json.dumps(jobs))
+    results_path = tmp_path / 'results.json'
+
+    argv = ['batch.py', str(jobs_path), '--output-dir', str(tmp_path / 'out'), '--results', str(results_path)]
+    monkeypatch.setattr(sys, 'argv', argv)
+    with pytest.raises(SystemExit) as e:
+        batch.main()
+    assert e.value.code == 1
+    assert (tmp_path / 'out' / 'good' / 'deals.ndjson').exists()
+    results = json.loads(results_path.read_text())['results']
+    assert sorted((r['connection'], r['error'] is None) for r in results) == [('bad', False), ('good', True)]
+
+    jobs['connections'] = [get_connection('good', server)]
+    jobs_path.write_text(json.dumps(jobs))
+    batch.main()
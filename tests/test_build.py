@@ -0,0 +1,13 @@
+# the function files are built from the shared engine
+
+import os
+import sys
+
+from conftest import ROOT_DIR
+
+sys.path.insert(0, ROOT_DIR)
+
+import build
+
+def test_functions_match_engine():
+    assert [os.path.relpath(p, ROOT_DIR) for p in build.build(check=True)] == []
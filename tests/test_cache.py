@@ -0,0 +1,107 @@
+# the page cache, which returns a collection from the cache when all of its
+# pages were saved by the same request of the collection within CACHE_TTL
+
+import os
+import json
+import asyncio
+
+import pytest
+
+def get_cache_files(module):
+    return [os.path.join(module.CACHE_DIR, name) for name in sorted(os.listdir(module.CACHE_DIR)) if not name.startswith('.')]
+
+def get_pull_path(module, server):
+    return module.get_pull_path(server.url + module.ITEM_PATH, module.ITEM_QUERY_PARAMS, {'Authorization': 'Bearer test'})
+
+def rewrite_cache_info(path, **values):
+    with open(path, 'rb') as f:
+        cache_info = json.loads(f.readline().decode('utf-8'))
+        content = f.read()
+    cache_info.update(values)
+    with open(path, 'wb') as f:
+        f.write(json.dumps(cache_info).encode('utf-8') + b"\n" + content)
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_cached_collection_is_replayed(use_async, make_server, load_function, run):
+
+    # the second call returns the collection from the cache without any
+    # requests
+    if use_async:
+        pytest.importorskip('httpx')
+    server = make_server(count=100)
+    module = load_function('deals')
+    module.CACHE_TTL = 60
+    expected = bytes(run(module, server, {'page_size': 30}).data)
+    request_count = server.stats['requests']
+    assert os.path.exists(get_pull_path(module, server))
+
+    if use_async:
+        connection = {'access_token': 'test', 'api_base_uri': server.url}
+
+        async def get_data():
+            data = bytearray()
+            async for chunk in module.get_data_async({'pipedrive_connection': connection, 'page_size': 30}):
+                data += chunk
+            await module.close_async_client()
+            return bytes(data)
+
+        data = asyncio.run(get_data())
+    else:
+        data = bytes(run(module, server, {'page_size': 30}).data)
+
+    assert data == expected
+    assert server.stats['requests'] == request_count
+
+def test_cached_collection_with_page_from_another_request(make_server, load_function, run):
+
+    # a page that was saved by another request of the collection, which
+    # may have seen different items, isn't mixed with the others; the
+    # collection is requested again instead
+    server = make_server(count=100)
+    module = load_function('deals')
+    module.CACHE_TTL = 60
+    expected = bytes(run(module, server, {'page_size': 30}).data)
+    request_count = server.stats['requests']
+
+    with open(get_pull_path(module, server), 'rb') as f:
+        pull_info = json.loads(f.read())
+    assert len(pull_info['pages']) == 4
+    rewrite_cache_info(os.path.join(module.CACHE_DIR, pull_info['pages'][1]), generation='another')
+
+    assert bytes(run(module, server, {'page_size': 30}).data) == expected
+    assert server.stats['requests'] >= request_count + len(pull_info['pages'])
+
+    # the pages are saved again by the new request, so the next call
+    # returns them from the cache
+    request_count = server.stats['requests']
+    assert bytes(run(module, server, {'page_size': 30}).data) == expected
+    assert server.stats['requests'] == request_count
+
+def test_cached_collection_expires(make_server, load_function, run):
+    server = make_server(count=100)
+    module = load_function('deals')
+    module.CACHE_TTL = 60
+    expected = bytes(run(module, server, {'page_size': 30}).data)
+    request_count = server.stats['requests']
+
+    pull_path = get_pull_path(module, server)
+    with open(pull_path, 'rb') as f:
+        pull_info = json.loads(f.read())
+    pull_info['time'] = pull_info['time'] - 60
+    with open(pull_path, 'wb') as f:
+        f.write(json.dumps(pull_info).encode('utf-8'))
+
+    assert bytes(run(module, server, {'page_size': 30}).data) == expected
+    assert server.stats['requests'] >= request_count + len(pull_info['pages'])
+
+def test_pages_arent_cached_by_default(make_server, load_function, run):
+
+    # with the cache off, which is the default, each call requests the items
+    server = make_server(count=10)
+    module = load_function('deals')
+    assert module.CACHE_TTL == 0
+    run(module, server)
+    server.update_item('deals', 3, title='changed')
+    rows = [json.loads(line) for line in bytes(run(module, server).data).splitlines()]
+    assert [r['title'] for r in rows if r['id'] == 3] == ['changed']
+    assert not os.path.exists(module.CACHE_DIR) or get_cache_files(module) == []
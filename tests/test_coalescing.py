@@ -0,0 +1,43 @@
+# concurrent calls for the same pages share the requests for them
+
+import json
+import threading
+import urllib.parse
+
+def get_rows(data):
+    return [json.loads(line) for line in bytes(data).decode('utf-8').splitlines()]
+
+def test_concurrent_calls_are_coalesced(make_server, load_function, run):
+
+    # the latency keeps the requests of the calls in flight at the same
+    # time; each call still returns all of the rows and records its own
+    # metrics
+    server = make_server(latency=0.2)
+    module = load_function('deals')
+    expected = get_rows(run(module, server).data)
+
+    del server.paths[:]
+    call_count = 4
+    barrier = threading.Barrier(call_count)
+    outputs = [None] * call_count
+    metrics = [module.Metrics() for i in range(call_count)]
+
+    def call(i):
+        barrier.wait()
+        outputs[i] = run(module, server, {}, metrics[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(call_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i in range(call_count):
+        assert get_rows(outputs[i].data) == expected
+        summary = metrics[i].get_summary()
+        assert summary['rows'] == len(expected)
+        assert summary['bytes_out'] == len(outputs[i].data)
+
+    item_requests = [p for p in server.paths if urllib.parse.urlparse(p).path == '/v1/deals']
+    assert len(item_requests) < call_count
+    assert sum(m.get_summary()['coalesced'] for m in metrics) > 0
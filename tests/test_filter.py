@@ -0,0 +1,112 @@
+# the properties returned, the filter on them and the conditions that are
+# pushed down to the api query
+
+import io
+import csv
+import json
+import urllib.parse
+
+import pytest
+
+def get_rows(data):
+    return [json.loads(line) for line in bytes(data).decode('utf-8').splitlines()]
+
+def get_item_queries(server, path):
+
+    # the query params of the requests for the item pages
+    queries = []
+    for request_path in server.paths:
+        url = urllib.parse.urlparse(request_path)
+        if url.path == path:
+            queries.append(dict(urllib.parse.parse_qsl(url.query)))
+    return queries
+
+def test_properties_are_returned_in_order(server, load_function, run):
+    module = load_function('deals')
+    expected = get_rows(run(module, server, {'properties': 'id,title,org_address,stage_name'}).data)
+
+    rows = get_rows(run(module, server, {'properties': 'title, id,stage_name'}).data)
+    assert [list(row.keys()) for row in rows] == [['title', 'id', 'stage_name']] * len(expected)
+    assert rows == [{'title': r['title'], 'id': r['id'], 'stage_name': r['stage_name']} for r in expected]
+
+    rows = get_rows(run(module, server, {'properties': ['id', 'org_address']}).data)
+    assert rows == [{'id': r['id'], 'org_address': r['org_address']} for r in expected]
+
+def test_repeated_properties_are_returned_once(server, load_function, run):
+    module = load_function('deals')
+    expected = get_rows(run(module, server, {'properties': 'id,title'}).data)
+    assert get_rows(run(module, server, {'properties': 'id,title,ID, id'}).data) == expected
+
+    data = bytes(run(module, server, {'properties': ['id,title', 'id'], 'format': 'csv'}).data)
+    rows = list(csv.reader(io.StringIO(data.decode('utf-8'))))
+    assert rows[0] == ['id', 'title']
+    assert rows[1:] == [[str(r['id']), r['title']] for r in expected]
+
+def test_invalid_property(server, load_function, run):
+    with pytest.raises(ValueError):
+        run(load_function('deals'), server, {'properties': 'id,unknown'})
+
+def test_filter_on_properties(make_server, load_function, run):
+    server = make_server()
+    module = load_function('deals')
+    expected = get_rows(run(module, server).data)
+
+    # conditions on the same property are or'd together and conditions on
+    # different properties and'ed; currency isn't an api param, so it's
+    # only checked against the items
+    del server.paths[:]
+    rows = get_rows(run(module, server, {'filter': 'currency=usd&currency=EUR&active=true'}).data)
+    assert rows == [r for r in expected if r['currency'] in ('USD', 'EUR') and r['active'] == True]
+    assert len(rows) > 0
+    assert all('currency' not in q for q in get_item_queries(server, '/v1/deals'))
+
+def test_filter_on_property_not_returned(server, load_function, run):
+    module = load_function('deals')
+    expected = get_rows(run(module, server).data)
+
+    rows = get_rows(run(module, server, {'properties': 'id', 'filter': 'status=lost'}).data)
+    assert rows == [{'id': r['id']} for r in expected if r['status'] == 'lost']
+
+def test_filter_pushdown(make_server, load_function, run):
+    server = make_server()
+    module = load_function('deals')
+    expected = get_rows(run(module, server).data)
+
+    # a single value for an api param is sent with the request for the
+    # items; the mock server ignores it, so the rows show that the
+    # condition is still checked against each item
+    del server.paths[:]
+    rows = get_rows(run(module, server, {'filter': 'status=won'}).data)
+    assert rows == [r for r in expected if r['status'] == 'won']
+    assert [q.get('status') for q in get_item_queries(server, '/v1/deals')] == ['won']
+
+    # more than one value can't be sent, so the items are requested in full
+    del server.paths[:]
+    rows = get_rows(run(module, server, {'filter': 'status=won&status=lost'}).data)
+    assert rows == [r for r in expected if r['status'] in ('won', 'lost')]
+    assert [q.get('status') for q in get_item_queries(server, '/v1/deals')] == [None]
+
+    # keys that aren't properties are only used in the api query
+    del server.paths[:]
+    rows = get_rows(run(module, server, {'filter': 'filter_id=7'}).data)
+    assert rows == expected
+    assert [q.get('filter_id') for q in get_item_queries(server, '/v1/deals')] == ['7']
+
+def test_invalid_filter(server, load_function, run):
+    module = load_function('deals')
+    with pytest.raises(ValueError):
+        run(module, server, {'filter': 'unknown=1'})
+    with pytest.raises(ValueError):
+        run(module, server, {'filter': 'filter_id=1&filter_id=2'})
+
+def test_lookup_returns_a_row_per_key(server, load_function, run):
+    module = load_function('people')
+    params = {'properties': 'id,name', 'lookup': '3, 999,person5@example.com,3,+1 555 0000004'}
+    rows = get_rows(run(module, server, params).data)
+    assert rows == [
+        {'lookup_key': '3', 'id': 3, 'name': 'Person 3'},
+        {'lookup_key': '999', 'id': None, 'name': None},
+        {'lookup_key': 'person5@example.com', 'id': 5, 'name': 'Person 5'},
+        {'lookup_key': '3', 'id': 3, 'name': 'Person 3'},
+        {'lookup_key': '+1 555 0000004', 'id': 4, 'name': 'Person 4'}
+    ]
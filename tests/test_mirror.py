@@ -0,0 +1,132 @@
+# incremental syncs through the local mirror of the items
+
+import json
+import time
+import sqlite3
+import threading
+import urllib.parse
+
+import pytest
+
+def get_rows(data):
+    return [json.loads(line) for line in bytes(data).decode('utf-8').splitlines()]
+
+def get_request_paths(server):
+    return [urllib.parse.urlparse(p).path for p in server.paths]
+
+@pytest.mark.parametrize('name, entity, deleted', [
+    ('deals', 'deals', {'deleted': True}),
+    ('people', 'persons', {'active_flag': False}),
+    ('organizations', 'organizations', {'active_flag': False}),
+    ('products', 'products', {'deleted': True})
+])
+def test_incremental_sync(name, entity, deleted, make_server, load_function, run):
+    server = make_server()
+    module = load_function(name)
+    params = {'sync': 'incremental'}
+
+    # the first call fills the mirror with all of the items
+    assert get_rows(run(module, server, params).data) == get_rows(run(module, server).data)
+
+    # later calls only request the items changed since then and apply the
+    # updates and deletes to the mirror
+    server.update_item(entity, 3, name='Renamed', title='Renamed', update_time='2030-01-01 00:00:00')
+    server.update_item(entity, 5, update_time='2030-01-01 00:00:00', **deleted)
+    expected = get_rows(run(module, server).data)
+    assert 5 not in [r['id'] for r in expected]
+
+    del server.paths[:]
+    rows = get_rows(run(module, server, params).data)
+    assert rows == expected
+    assert '/v1/recents' in get_request_paths(server)
+    assert '/' + entity not in [p[len('/v1'):] for p in get_request_paths(server)]
+
+def test_incremental_sync_keeps_inactive_products(make_server, load_function, run):
+    server = make_server()
+    module = load_function('products')
+    params = {'sync': 'incremental'}
+
+    # inactive products are returned by the api, so they're kept in the
+    # mirror when they're first loaded and when they're changed later
+    server.update_item('products', 2, active_flag=False)
+    assert get_rows(run(module, server, params).data) == get_rows(run(module, server).data)
+
+    server.update_item('products', 4, active_flag=False, update_time='2030-01-01 00:00:00')
+    expected = get_rows(run(module, server).data)
+    assert set((r['id'], r['active_flag']) for r in expected if r['id'] in (2, 4)) == set([(2, False), (4, False)])
+    assert get_rows(run(module, server, params).data) == expected
+
+def test_incremental_sync_filter(make_server, load_function, run):
+    server = make_server()
+    module = load_function('deals')
+
+    # conditions on the mirror's indexes are answered by the mirror and the
+    # rest are checked against each item
+    expected = get_rows(run(module, server, {'filter': 'status=open&currency=USD'}).data)
+    run(module, server, {'sync': 'incremental'})
+    rows = get_rows(run(module, server, {'sync': 'incremental', 'filter': 'status=open&currency=USD'}).data)
+    assert rows == expected
+
+def test_mirror_is_private(make_server, load_function, run, tmp_path):
+    server = make_server()
+    module = load_function('deals')
+    run(module, server, {'sync': 'incremental'})
+
+    mirror_dir = tmp_path / 'mirrors'
+    assert mirror_dir.stat().st_mode & 0o777 == 0o700
+    for path in mirror_dir.iterdir():
+        assert path.stat().st_mode & 0o077 == 0
+
+def test_concurrent_incremental_syncs(make_server, load_function, run):
+
+    # a call that starts while the mirror is first filled waits for it and
+    # then only requests the recent changes
+    server = make_server(count=300, latency=0.05)
+    module = load_function('deals')
+    params = {'sync': 'incremental', 'page_size': 50}
+
+    outputs = [None, None]
+
+    def call(i):
+        outputs[i] = run(module, server, params)
+
+    first = threading.Thread(target=call, args=(0,))
+    first.start()
+    while '/v1/deals' not in get_request_paths(server):
+        time.sleep(0.01)
+    second = threading.Thread(target=call, args=(1,))
+    second.start()
+    first.join()
+    second.join()
+
+    assert get_rows(outputs[0].data) == get_rows(outputs[1].data)
+    assert len(get_rows(outputs[0].data)) == 300
+    assert get_request_paths(server).count('/v1/deals') <= 300 // 50 + module.PAGE_CONCURRENCY
+    assert '/v1/recents' in get_request_paths(server)
+
+def test_interrupted_update_leaves_mirror(make_server, load_function, run, monkeypatch, tmp_path):
+    server = make_server()
+    module = load_function('deals')
+    params = {'sync': 'incremental'}
+    expected = get_rows(run(module, server, params).data)
+
+    # the changes staged before the error aren't applied
+    get_item_pages = module.get_item_pages
+
+    def get_failing_item_pages(*args, **kwargs):
+        for data in get_item_pages(*args, **kwargs):
+            yield data
+            raise IOError('Connection lost')
+
+    server.update_item('deals', 5, deleted=True)
+    monkeypatch.setattr(module, 'get_item_pages', get_failing_item_pages)
+    with pytest.raises(IOError):
+        run(module, server, params)
+
+    mirror_path, = (tmp_path / 'mirrors').glob('*.sqlite')
+    connection = sqlite3.connect(str(mirror_path))
+    assert connection.execute('SELECT COUNT(*) FROM items WHERE id = 5').fetchone()[0] == 1
+    connection.close()
+
+    monkeypatch.setattr(module, 'get_item_pages', get_item_pages)
+    assert get_rows(run(module, server, params).data) == [r for r in expected if r['id'] != 5]
@@ -0,0 +1,182 @@
+# the rows returned by default and their encoding in each of the output
+# formats
+
+import io
+import os
+import csv
+import gzip
+import json
+import asyncio
+
+import pytest
+
+from conftest import FUNCTIONS, ROOT_DIR
+
+def get_rows(data):
+
+    # the rows are compared with their keys in order
+    return [list(json.loads(line).items()) for line in bytes(data).decode('utf-8').splitlines()]
+
+@pytest.mark.parametrize('name', FUNCTIONS)
+def test_default_output_matches_baseline(name, server, load_function, run):
+
+    # the baseline rows were written by the functions as they were before
+    # any of the changes to the engine, against a mock server with the same
+    # item count
+    with open(os.path.join(ROOT_DIR, 'tests', 'baseline', name + '.ndjson'), 'rb') as f:
+        expected = get_rows(f.read())
+
+    module = load_function(name)
+    output = run(module, server)
+    assert output.content_type == 'application/x-ndjson'
+    assert get_rows(output.data) == expected
+
+@pytest.mark.parametrize('name', ['deals', 'activity'])
+def test_default_output_doesnt_request_reference_data(name, make_server, load_function, run):
+
+    # the properties from reference data are only returned when asked for,
+    # so the default output only requests the items themselves
+    server = make_server()
+    module = load_function(name)
+    run(module, server)
+    assert [path for path in server.paths if not path.startswith(module.ITEM_PATH)] == []
+
+@pytest.mark.parametrize('name', ['deals', 'products'])
+def test_paged_output_matches_single_page(name, server, load_function, run):
+    module = load_function(name)
+    expected = get_rows(run(module, server).data)
+    assert get_rows(run(module, server, {'page_size': 3}).data) == expected
+
+@pytest.mark.parametrize('name', ['deals', 'products'])
+def test_async_output_matches_sync(name, server, load_function, run):
+    pytest.importorskip('httpx')
+    module = load_function(name)
+    params = {'pipedrive_connection': {'access_token': 'test', 'api_base_uri': server.url}}
+
+    async def get_data():
+        data = bytearray()
+        async for chunk in module.get_data_async(dict(params, page_size=3)):
+            data += chunk
+        await module.close_async_client()
+        return data
+
+    assert get_rows(asyncio.run(get_data())) == get_rows(run(module, server).data)
+
+@pytest.mark.parametrize('name,params', [
+    ('deals', {'properties': '*'}),
+    ('deals', {'sync': 'incremental'}),
+    ('people', {'lookup': '1,2,missing@example.com,1', 'format': 'csv'}),
+    ('activity', {'format': 'csv', 'compression': 'gzip'})
+])
+def test_async_requests_are_made_on_the_event_loop(name, params, server, load_function, run, monkeypatch):
+
+    # the related items, reference data, lookups and mirror updates of an
+    # async call are requested with httpx rather than with blocking requests
+    pytest.importorskip('httpx')
+    module = load_function(name)
+    expected = bytes(run(module, server, params).data)
+    module.reference_items.clear()
+    module.lookup_items_memo.clear()
+    module.MIRROR_DIR = module.MIRROR_DIR + '-async'
+
+    def send_request(*args, **kwargs):
+        raise AssertionError('blocking request')
+
+    monkeypatch.setattr(module, 'send_request', send_request)
+    connection = {'access_token': 'test', 'api_base_uri': server.url}
+
+    async def get_data():
+        data = bytearray()
+        async for chunk in module.get_data_async(dict(params, pipedrive_connection=connection)):
+            data += chunk
+        await module.close_async_client()
+        return bytes(data)
+
+    data = asyncio.run(get_data())
+    if params.get('compression') == 'gzip':
+        data, expected = gzip.decompress(data), gzip.decompress(expected)
+    assert data == expected
+
+def test_async_calls_share_the_cpu_threads(make_server, load_function):
+
+    # concurrent async calls don't start a thread each; their cpu work is
+    # done on the ASYNC_CPU_WORKERS threads shared by all of them
+    pytest.importorskip('httpx')
+    import threading
+    server = make_server(count=200, latency=0.01)
+    module = load_function('deals')
+    module.ASYNC_CPU_WORKERS = 2
+    connection = {'access_token': 'test', 'api_base_uri': server.url}
+    before = set(threading.enumerate())
+    started = set()
+
+    async def get_data():
+        data = bytearray()
+        async for chunk in module.get_data_async({'pipedrive_connection': connection, 'page_size': 20}):
+            data += chunk
+            started.update(t for t in threading.enumerate() if t not in before and 'process_request' not in t.name)
+        return bytes(data)
+
+    async def get_all():
+        try:
+            return await asyncio.gather(*[get_data() for i in range(20)])
+        finally:
+            await module.close_async_client()
+
+    outputs = asyncio.run(get_all())
+    assert len(set(outputs)) == 1 and len(outputs[0]) > 0
+    assert len(started) <= 2
+    assert all(t.name.startswith('pipedrive-cpu') for t in started)
+
+def to_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+@pytest.mark.parametrize('name', FUNCTIONS)
+def test_csv_round_trip(name, server, load_function, run):
+    module = load_function(name)
+    expected = get_rows(run(module, server).data)
+
+    output = run(module, server, {'format': 'csv'})
+    assert output.content_type == 'text/csv'
+    rows = list(csv.reader(io.StringIO(bytes(output.data).decode('utf-8'))))
+    assert rows[0] == [k for k, v in expected[0]]
+    assert rows[1:] == [[to_csv_value(v) for k, v in row] for row in expected]
+
+@pytest.mark.parametrize('output_format', ['arrow', 'parquet'])
+@pytest.mark.parametrize('name', FUNCTIONS)
+def test_arrow_round_trip(name, output_format, server, load_function, run):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    module = load_function(name)
+    expected = get_rows(run(module, server).data)
+
+    output = run(module, server, {'format': output_format})
+    assert output.content_type == module.OUTPUT_FORMATS[output_format]
+    if output_format == 'parquet':
+        table = pyarrow.parquet.read_table(io.BytesIO(bytes(output.data)))
+    else:
+        table = pyarrow.ipc.open_stream(bytes(output.data)).read_all()
+    assert table.schema.names == [k for k, v in expected[0]]
+    assert [list(row.items()) for row in table.to_pylist()] == expected
+
+@pytest.mark.parametrize('output_format', ['ndjson', 'csv'])
+def test_gzip_round_trip(output_format, server, load_function, run):
+    module = load_function('deals')
+    expected = run(module, server, {'format': output_format}).data
+
+    output = run(module, server, {'format': output_format, 'compression': 'gzip'})
+    assert output.content_type == 'application/gzip'
+    assert gzip.decompress(bytes(output.data)) == expected
+
+def test_invalid_output_params(server, load_function, run):
+    module = load_function('deals')
+    with pytest.raises(ValueError):
+        run(module, server, {'format': 'xml'})
+    with pytest.raises(ValueError):
+        run(module, server, {'compression': 'zip'})
@@ -0,0 +1,86 @@
+# the size of the pages requested, which is adjusted to the time and size
+# of the pages requested so far unless a page size is given
+
+import urllib.parse
+
+class Page:
+
+    def __init__(self, count, elapsed, content_size=1000, decode_time=0):
+        self.count = count
+        self.elapsed = elapsed
+        self.content_size = content_size
+        self.decode_time = decode_time
+
+class RateLimiter:
+
+    def __init__(self, headroom=1):
+        self.headroom = headroom
+
+    def get_headroom(self):
+        return self.headroom
+
+def test_slow_pages_are_made_smaller(load_function):
+
+    # the size moves halfway towards the size that would take
+    # PAGE_TARGET_TIME, and the time of a page includes its decode time
+    module = load_function('deals')
+    page_sizer = module.PageSizer(None, RateLimiter())
+    assert page_sizer.get_size() == module.PAGE_SIZE_MAX
+
+    target = module.PAGE_TARGET_TIME * 500 / (module.PAGE_TARGET_TIME * 4)
+    page_sizer.update(Page(500, module.PAGE_TARGET_TIME * 4))
+    assert page_sizer.get_size() == int((module.PAGE_SIZE_MAX + target) / 2)
+
+    decoded = module.PageSizer(None, RateLimiter())
+    decoded.update(Page(500, module.PAGE_TARGET_TIME, decode_time=module.PAGE_TARGET_TIME * 3))
+    assert decoded.get_size() == page_sizer.get_size()
+
+    for i in range(20):
+        page_sizer.update(Page(page_sizer.get_size(), 1000))
+    assert page_sizer.get_size() == module.PAGE_SIZE_MIN
+
+def test_large_pages_are_made_smaller(load_function):
+    module = load_function('deals')
+    page_sizer = module.PageSizer(None, RateLimiter())
+    page_sizer.update(Page(500, 0.1, content_size=module.PAGE_TARGET_BYTES * 4))
+    assert page_sizer.get_size() == int((module.PAGE_SIZE_MAX + 125) / 2)
+
+def test_pages_arent_made_smaller_without_rate_limit_headroom(load_function):
+
+    # smaller pages take more requests, so they're kept as they are when
+    # little of the rate limit is left
+    module = load_function('deals')
+    page_sizer = module.PageSizer(None, RateLimiter(module.PAGE_MIN_HEADROOM / 2))
+    page_sizer.update(Page(500, module.PAGE_TARGET_TIME * 4))
+    assert page_sizer.get_size() == module.PAGE_SIZE_MAX
+
+def test_given_page_size_is_kept(load_function):
+    module = load_function('deals')
+    page_sizer = module.PageSizer(20, RateLimiter())
+    page_sizer.update(Page(20, module.PAGE_TARGET_TIME * 100))
+    page_sizer.update(Page(20, 0.001, content_size=module.PAGE_TARGET_BYTES * 100))
+    assert page_sizer.get_size() == 20
+
+def test_pages_from_the_cache_dont_change_the_size(load_function):
+    module = load_function('deals')
+    page_sizer = module.PageSizer(None, RateLimiter())
+    page_sizer.update(Page(500, None))
+    page_sizer.update(Page(0, 100))
+    assert page_sizer.get_size() == module.PAGE_SIZE_MAX
+
+def test_page_size_follows_response_times(make_server, load_function, run):
+
+    # with a target time shorter than the latency of the server, the pages
+    # requested get smaller while all of the items are still returned once
+    server = make_server(count=2000)
+    module = load_function('deals')
+    expected = bytes(run(module, server).data)
+
+    server = make_server(count=2000, latency=0.2)
+    module = load_function('deals')
+    module.PAGE_TARGET_TIME = 0.05
+    assert bytes(run(module, server).data) == expected
+
+    limits = [int(urllib.parse.parse_qs(urllib.parse.urlparse(p).query)['limit'][0]) for p in server.paths]
+    assert limits[0] == module.PAGE_SIZE_MAX
+    assert min(limits) < module.PAGE_SIZE_MAX
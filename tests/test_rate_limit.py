@@ -0,0 +1,161 @@
+# pacing requests to the rate limit reported by the api and retrying the
+# requests that are rate limited or fail anyway
+
+import time
+import asyncio
+
+import pytest
+
+class Response:
+
+    # the parts of a response used by the rate limiter and send_request
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def get_rate_limit_headers(limit, remaining, reset):
+    return {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(reset)}
+
+def test_rate_limiter_paces_requests(load_function):
+
+    # requests aren't paced until the limit is known, and then a request
+    # is allowed every window / limit seconds once the tokens run out
+    module = load_function('deals')
+    rate_limiter = module.RateLimiter(2)
+    assert rate_limiter.reserve() == 0
+
+    rate_limiter.update(Response(200, get_rate_limit_headers(10, 3, 2)))
+    assert [rate_limiter.reserve() for i in range(3)] == [0, 0, 0]
+    assert rate_limiter.reserve() == pytest.approx(0.2, abs=0.02)
+
+def test_rate_limiter_waits_for_reset(load_function):
+
+    # when no requests are left, requests wait for the window to reset; a
+    # rate limited request waits for Retry-After, then for the reset when
+    # there's no Retry-After, and then for a second when there's neither
+    module = load_function('deals')
+    cases = [
+        (Response(200, get_rate_limit_headers(10, 0, 3)), 3),
+        (Response(429, dict(get_rate_limit_headers(10, 0, 1), **{'Retry-After': '4'})), 4),
+        (Response(429, get_rate_limit_headers(10, 0, 3)), 3),
+        (Response(429), 1)
+    ]
+    for response, delay in cases:
+        rate_limiter = module.RateLimiter(2)
+        rate_limiter.update(response)
+        assert rate_limiter.reserve() == pytest.approx(delay, abs=0.05)
+
+    rate_limiter = module.RateLimiter(2)
+    rate_limiter.update(Response(200, get_rate_limit_headers(10, 5, 3)))
+    assert rate_limiter.reserve() == 0
+
+def test_rate_limited_requests_are_retried_up_to_the_limit(load_function, monkeypatch):
+
+    # a request that's still rate limited after RATE_LIMIT_RETRIES retries
+    # is returned to the caller as it is
+    module = load_function('deals')
+    module.RATE_LIMIT_RETRIES = 2
+    responses = []
+
+    class Session:
+        def get(self, url, **kwargs):
+            responses.append(Response(429, {'Retry-After': '0'}))
+            return responses[-1]
+
+    monkeypatch.setattr(module, 'get_session', lambda: Session())
+    metrics = module.Metrics()
+    response = module.send_request('http://127.0.0.1/v1/deals', {'Authorization': 'Bearer test'}, metrics)
+    assert response.status_code == 429
+    assert len(responses) == 3
+    assert all(r.closed for r in responses[:-1])
+    assert metrics.get_summary()['rate_limited'] == 3
+
+def test_rate_limited_async_requests_are_retried_up_to_the_limit(load_function):
+    httpx = pytest.importorskip('httpx')
+    module = load_function('deals')
+    module.RATE_LIMIT_RETRIES = 2
+    requests = []
+
+    def handle(request):
+        requests.append(request)
+        return httpx.Response(429, headers={'Retry-After': '0'})
+
+    async def send_request():
+        module.async_clients[asyncio.get_running_loop()] = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        try:
+            return await module.send_request_async('http://127.0.0.1/v1/deals', {'Authorization': 'Bearer test'}, module.Metrics())
+        finally:
+            await module.close_async_client()
+
+    assert asyncio.run(send_request()).status_code == 429
+    assert len(requests) == 3
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_requests_stay_under_the_rate_limit(use_async, make_server, load_function, run):
+
+    # all of the items are returned and the requests that were rate
+    # limited anyway were retried rather than reaching the caller; the
+    # requests are spread over the windows of the limit
+    if use_async:
+        pytest.importorskip('httpx')
+    server = make_server(count=1000)
+    module = load_function('deals')
+    expected = bytes(run(module, server, {'page_size': 50}).data)
+
+    server = make_server(count=1000, rate_limit=10)
+    module = load_function('deals')
+    metrics = module.Metrics()
+    start = time.monotonic()
+    if use_async:
+        connection = {'access_token': 'test', 'api_base_uri': server.url}
+
+        async def get_data():
+            data = bytearray()
+            async for chunk in module.get_data_async({'pipedrive_connection': connection, 'page_size': 50}, metrics):
+                data += chunk
+            await module.close_async_client()
+            return bytes(data)
+
+        data = asyncio.run(get_data())
+    else:
+        data = bytes(run(module, server, {'page_size': 50}, metrics).data)
+    elapsed = time.monotonic() - start
+
+    summary = metrics.get_summary()
+    assert data == expected
+    assert summary['rate_limited'] == server.stats['rate_limited']
+    assert server.stats['rate_limited'] <= 2
+    assert summary['requests'] == server.stats['requests']
+    assert 20 <= server.stats['requests'] - server.stats['rate_limited'] <= 20 + module.PAGE_CONCURRENCY
+    assert elapsed >= (20 - 10) / 10 * module.RATE_LIMIT_WINDOW * 0.9
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_server_errors_are_retried(use_async, make_server, load_function, run):
+    if use_async:
+        pytest.importorskip('httpx')
+    server = make_server(count=1000)
+    module = load_function('deals')
+    expected = bytes(run(module, server, {'page_size': 100}).data)
+
+    server = make_server(count=1000, error_rate=0.3)
+    module = load_function('deals')
+    if use_async:
+        connection = {'access_token': 'test', 'api_base_uri': server.url}
+
+        async def get_data():
+            data = bytearray()
+            async for chunk in module.get_data_async({'pipedrive_connection': connection, 'page_size': 100}):
+                data += chunk
+            await module.close_async_client()
+            return bytes(data)
+
+        data = asyncio.run(get_data())
+    else:
+        data = bytes(run(module, server, {'page_size': 100}).data)
+
+    assert server.stats['errors'] > 0
+    assert data == expected
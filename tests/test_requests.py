@@ -0,0 +1,60 @@
+# requests for pages that are no longer needed and requests that stall
+
+import time
+import socket
+import threading
+
+import pytest
+import requests
+
+def test_pages_ahead_are_not_sent_after_the_pull_ends(make_server, load_function):
+
+    # with two requests allowed per window, the pages requested ahead
+    # along with the second page wait on the rate limiter; they're dropped
+    # rather than sent once the pull is closed
+    server = make_server(count=2000, rate_limit=2)
+    module = load_function('deals')
+    headers = {'Authorization': 'Bearer test'}
+    metrics = module.Metrics()
+
+    pages = module.get_pages(server.url + module.ITEM_PATH, {}, headers, metrics, page_size=100)
+    for i in range(2):
+        page = next(pages)
+        assert len(list(page.items)) == 100
+    pages.close()
+
+    time.sleep(0.2)
+    request_count = server.stats['requests']
+    time.sleep(module.RATE_LIMIT_WINDOW * 2)
+    assert server.stats['requests'] == request_count
+    assert request_count <= 3
+
+def test_stalled_requests_time_out(load_function):
+
+    # a server that accepts connections and never responds
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(listener.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+
+    module = load_function('deals')
+    module.REQUEST_READ_TIMEOUT = 0.2
+    url = 'http://127.0.0.1:%d/v1/deals' % listener.getsockname()[1]
+    start = time.monotonic()
+    try:
+        with pytest.raises(requests.exceptions.RequestException):
+            module.send_request(url, {'Authorization': 'Bearer test'}, module.Metrics())
+    finally:
+        listener.close()
+        for connection in connections:
+            connection.close()
+    assert time.monotonic() - start < 5